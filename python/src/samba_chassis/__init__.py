@@ -1,6 +1,10 @@
+import functools
+import hashlib
 import json
-import yaml
 import os
+import tempfile
+
+_yaml_loader = None
 
 
 def dict_from_env(prefix=""):
@@ -11,25 +15,75 @@ def dict_from_env(prefix=""):
     :param prefix: Prefix that determines valid variables.
     :return: Dictionary with valid environment variable with the prefix removed.
     """
-    r = {}
-    for key in os.environ:
-        if key.startswith(prefix):
-            r[key[len(prefix):]] = os.environ[key]
-    return r
+    environ = dict(os.environ)
+    if not prefix:
+        return environ
+    prefix_len = len(prefix)
+    return {key[prefix_len:]: value for key, value in environ.items() if key.startswith(prefix)}
 
 
 def dict_from_yaml(filename):
-    """Return a dictionary taken from an YAML file."""
-    with open(filename) as config_file:
-        return yaml.safe_load(config_file)
+    """
+    Return a dictionary taken from an YAML file.
+
+    The parsed content is cached in a sibling JSON file ([filename].json) along with a hash of the
+    YAML file, and the cache is used instead of parsing for as long as the hash matches and it loads.
+    :param filename: YAML file name.
+    :return: Dictionary with the file's content.
+    """
+    with open(filename, "rb") as config_file:
+        data = config_file.read()
+    digest = hashlib.sha1(data).hexdigest()
+    cache = filename + ".json"
+    try:
+        cached = dict_from_json(cache)
+        if isinstance(cached, dict) and cached.get("sha1") == digest and "content" in cached:
+            return cached["content"]
+    except (ValueError, IOError, OSError):
+        pass
+    import yaml
+    global _yaml_loader
+    if _yaml_loader is None:
+        _yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    r = yaml.load(data, Loader=_yaml_loader)
+    _write_json_cache(cache, {"sha1": digest, "content": r})
+    return r
 
 
 def dict_from_json(filename):
     """Return a dictionary taken from a JSON file."""
-    with open(filename) as config_file:
+    with open(filename, "rb") as config_file:
         return json.load(config_file)
 
 
+def _write_json_cache(cache, content):
+    """
+    Write content as JSON to the cache file when it survives a JSON round trip.
+
+    The content goes to a temporary file first that then replaces the cache, so readers never see a
+    partial cache. Failing to write the cache (read only file systems, non JSON types) is not an error.
+    :param cache: cache file name.
+    :param content: content to be cached.
+    """
+    try:
+        dumped = json.dumps(content)
+        if json.loads(dumped) != content:
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache) or ".", prefix=".", suffix=".tmp")
+    except (TypeError, ValueError, IOError, OSError):
+        return
+    try:
+        with os.fdopen(fd, "w") as cache_file:
+            cache_file.write(dumped)
+        os.replace(tmp, cache)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+@functools.lru_cache(maxsize=256)
 def cap_first(line):
     """
     Capitalize the first letter of each word in snake case format.
@@ -37,4 +91,6 @@ def cap_first(line):
     :param line: snake case format line of characters
     :return: the good stuff
     """
+    if '_' not in line:
+        return line[:1].upper() + line[1:]
     return ''.join(s[:1].upper() + s[1:] for s in line.split('_'))
\ No newline at end of file
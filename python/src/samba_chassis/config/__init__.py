@@ -4,15 +4,20 @@
 Copyright (c) SambaTech. All rights reserved.
 
 created_at: 05-JUL-2018
-updated_at: 06-JUL-2018
+updated_at: 15-OCT-2026
 
 """
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import functools
 import os
 import warnings
 import samba_chassis
 
 _config_ledger = {}
+_simplify_cache = OrderedDict()
+# Layout dictionaries kept simplified, the oldest ones are dropped past this
+_simplify_cache_size = 64
+_namedtuple_cache = {}
 
 
 class ConfigItem(object):
@@ -23,15 +28,34 @@ class ConfigItem(object):
     """
     def __init__(self, default=None, type=None, rules=[]):
         self.default = default
-        self.current = default
         self.type = type
         self.rules = rules
+        self._current = default
+        self._dirty = False
+        self._default_ok = None
+
+    @property
+    def current(self):
+        return self._current
+
+    @current.setter
+    def current(self, value):
+        self._current = value
+        self._dirty = value is not self.default
 
     def eval(self):
-        if self.type is not None and not isinstance(self.current, self.type):
+        """Return whether the current value is valid. The default value is evaluated only once."""
+        if not self._dirty:
+            if self._default_ok is None:
+                self._default_ok = self._eval(self.default)
+            return self._default_ok
+        return self._eval(self._current)
+
+    def _eval(self, value):
+        if self.type is not None and not isinstance(value, self.type):
             return False
         for rule in self.rules:
-            if not rule(self.current):
+            if not rule(value):
                 return False
         return True
 
@@ -58,10 +82,12 @@ class ConfigLayout(object):
         """
         Initialize object with the configuration dictionary and a simple version of it.
 
+        The paths of the simple version are parsed once into the layout's retrieval plan.
         :param config_dict: Configuration dictionary with ConfigItem elements.
         """
         self.config_dict = config_dict
-        self.simple_dict = _simplify(config_dict)
+        self.simple_dict = _simplify_cached(config_dict)
+        self._plan = [(key, _parse_path(key), item) for key, item in self.simple_dict.items()]
 
     def get(self, config_object=None, base=None, config_entry="default"):
         """
@@ -77,21 +103,19 @@ class ConfigLayout(object):
             if base is None:
                 config_object = _config_ledger[config_entry]
             else:
-                path = base.split(".")
+                path = _parse_path(base)
                 try:
                     config_object = _retrieve(_config_ledger[config_entry], path)
-                except KeyError:
+                except (KeyError, AttributeError):
                     config_object = _objectify("Config", {})
         # Build final configuration object
-        for key in self.simple_dict:
-            path = key.split(".")
+        retrieve = _retrieve
+        for key, path, item in self._plan:
             try:
-                self.simple_dict[key].current = _retrieve(config_object, path)
-            except KeyError:
+                item.current = retrieve(config_object, path)
+            except (KeyError, AttributeError):
                 warnings.warn("Layout item {} not found in config object".format(key))
-            except AttributeError:
-                warnings.warn("Layout item {} not found in config object".format(key))
-            if not self.simple_dict[key].eval():
+            if not item.eval():
                 raise ValueError("{} is divergent".format(key))
 
         return _objectify("LayoutObject", self.config_dict)
@@ -134,7 +158,7 @@ def get(base=None, config_entry="default", config_layout=None):
     """
     if base is None:
         return _config_ledger[config_entry]
-    path = base.split(".")
+    path = _parse_path(base)
     ob = _retrieve(_config_ledger[config_entry], path)
     if config_layout is not None:
         return config_layout.get(config_object=ob)
@@ -169,23 +193,33 @@ def set(name, config_entry="default"):
     _config_ledger[config_entry] = config_object
 
 
+@functools.lru_cache(maxsize=1024)
+def _parse_path(base):
+    """
+    Parse a dotted path into a tuple of traversal steps.
+
+    Empty steps are dropped and numeric steps become list indexes.
+    :param base: dotted path (e.g. "tasks.pools.0.name").
+    :return: tuple with attribute names (str) and indexes (int).
+    """
+    return tuple(int(target) if target.isdecimal() else target for target in base.split(".") if target)
+
+
 def _retrieve(ob, path):
     """
     Retrieve object information from path.
 
     :param ob: object for retrieval.
-    :param path: list defining the path for object tree traversal.
+    :param path: steps defining the path for object tree traversal, either the strings of a split dotted path
+    or as returned by _parse_path.
     :return: the object within defined path.
     """
     for target in path:
-        if target == "":
-            continue
-        try:
-            index = int(target)
-            ob = ob[index]
-        except ValueError:
-            ob = getattr(ob, target)
-        except AttributeError:
+        if isinstance(target, int):
+            ob = ob[target]
+        elif target.isdecimal():
+            ob = ob[int(target)]
+        elif target:
             ob = getattr(ob, target)
     return ob
 
@@ -200,44 +234,78 @@ def _objectify(name, element, alias_dict={}):
     :param alias_dict: alias dictionary.
     :return: an object sub-structure.
     """
+    objectify = _objectify
     if isinstance(element, dict):
-        return namedtuple("Config{}".format(samba_chassis.cap_first(name)), element.keys())(
-            *[_objectify(i[0], i[1], alias_dict) for i in element.items()]
+        return _namedtuple_class(name, tuple(element.keys()))(
+            *[objectify(i[0], i[1], alias_dict) for i in element.items()]
         )
-    if isinstance(element, list):
-        return [_objectify("ListElement", i, alias_dict) for i in element]
-    if isinstance(element, tuple):
-        return [_objectify("TupleElement", i, alias_dict) for i in element]
+    if isinstance(element, (list, tuple)):
+        return [objectify("ListElement", i, alias_dict) for i in element]
     if isinstance(element, ConfigItem):
         return element.current
+    if type(element) is not str or not element.startswith("."):
+        return element
     try:
-        return alias_dict[element] if isinstance(element, str) and element[0] == "." else element
+        return alias_dict[element]
     except KeyError:
         warnings.warn("Alias reference {} can't be dereferenced".format(element))
         return element
 
 
+def _namedtuple_class(name, keys):
+    """
+    Return the configuration namedtuple class for a name and its fields, creating it only once.
+
+    :param name: element's name.
+    :param keys: tuple with the element's keys.
+    :return: a namedtuple class.
+    """
+    try:
+        return _namedtuple_cache[(name, keys)]
+    except KeyError:
+        klass = namedtuple("Config{}".format(samba_chassis.cap_first(name)), keys)
+        _namedtuple_cache[(name, keys)] = klass
+        return klass
+
+
+def _simplify_cached(element):
+    """
+    Simplify a dictionary memoizing the result by the dictionary's identity.
+
+    The cache keeps a reference to the element so its id can't be reused by another object, and
+    holds the _simplify_cache_size most recently simplified ones. It is meant for layout dictionaries,
+    that are built once and never mutated.
+    :param element: element to simplify.
+    :return: a copy of the simplified map.
+    """
+    try:
+        return dict(_simplify_cache[id(element)][1])
+    except KeyError:
+        simple = _simplify(element)
+        _simplify_cache[id(element)] = (element, simple)
+        if len(_simplify_cache) > _simplify_cache_size:
+            _simplify_cache.popitem(last=False)
+        return dict(simple)
+
+
 def _simplify(element, name=""):
     """
-    Simplify a dictionary into a map (alias):(non container element) recursively.
+    Simplify a dictionary into a map (alias):(non container element).
 
+    The tree is walked with an explicit stack and each alias is joined only once, at its leaf.
+    Children are pushed reversed so aliases come out in the same order as a recursive walk.
     :param name: element's name
     :param element: element, duh!
     :return: a simplified sub-map
     """
     s = {}
-    if isinstance(element, dict):
-        for key in element:
-            s.update(_simplify(element[key], "{}.{}".format(name, key)))
-    elif isinstance(element, list):
-        for i in range(len(element)):
-            s.update(_simplify(element[i], "{}.{}".format(name, i)))
-    elif isinstance(element, tuple):
-        for i in range(len(element)):
-            s.update(_simplify(element[i], "{}.{}".format(name, i)))
-    else:
-        s[name] = element
+    stack = [((), element)]
+    while stack:
+        parts, element = stack.pop()
+        if isinstance(element, dict):
+            stack.extend(reversed([(parts + (key,), value) for key, value in element.items()]))
+        elif isinstance(element, (list, tuple)):
+            stack.extend(reversed([(parts + (i,), value) for i, value in enumerate(element)]))
+        else:
+            s[".".join([name] + [str(part) for part in parts])] = element
     return s
-
-
-
@@ -4,7 +4,7 @@
 Copyright (c) SambaTech. All rights reserved.
 
 created_at: 09-JUL-2018
-updated_at: 18-DEC-2018
+updated_at: 15-OCT-2026
 
 This module provides a new Logger class more friendly to our micro services model.
 It can be configured using samba-chassis config framework to define a service name.
@@ -26,15 +26,21 @@ class ServiceLogger(logging.Logger):
 
     It always adds to extra job_id and job_name.
     """
-    def _log(self, level, msg, args, exc_info=None, extra={}, **kwargs):
-        extra["job_id"] = kwargs.get("job_id", extra.get("job_id", "unknown"))
-
-        extra["job_name"] = kwargs.get("job_name", extra.get("job_name", "unknown"))
+    def _log(self, level, msg, args, exc_info=None, extra=None, **kwargs):
+        # Build a new extra dict per record, so concurrent calls never share one
+        if extra is None:
+            extra = {"job_id": kwargs.get("job_id", "unknown"), "job_name": kwargs.get("job_name", "unknown")}
+        else:
+            extra = dict(extra)
+            extra["job_id"] = kwargs["job_id"] if "job_id" in kwargs else extra.get("job_id", "unknown")
+            extra["job_name"] = kwargs["job_name"] if "job_name" in kwargs else extra.get("job_name", "unknown")
 
         super(ServiceLogger, self)._log(level, msg, args, exc_info, extra)
 
 
 _loggerClass = ServiceLogger
+# Loggers already returned by getLogger, so repeated calls skip the logger class swap
+_loggers = {}
 
 
 def getLogger(name=None):
@@ -44,6 +50,14 @@ def getLogger(name=None):
     :param name: Logger name. If no name is specified, return the root logger.
     :return: Returns a new logger.
     """
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers[name] = _getLogger(name)
+    return logger
+
+
+def _getLogger(name):
+    """Return logging's logger for name, creating it as a _loggerClass if it does not exist yet."""
     def_klass = logging.getLoggerClass()
     if def_klass == _loggerClass:
         return logging.getLogger(name)
@@ -4,7 +4,7 @@
 Copyright (c) SambaTech. All rights reserved.
 
 created_at: 09-JUL-2018
-updated_at: 31-JUL-2018
+updated_at: 15-OCT-2026
 
 This module provides a logging handler to be used with google's stackdriver and kubernetes engine with fluentd.
 
@@ -15,7 +15,10 @@ logger.addhandler(ContainerEngineHandler())
 """
 import logging
 import json
-import math
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class ContainerEngineHandler(logging.StreamHandler):
@@ -29,7 +32,7 @@ class ContainerEngineHandler(logging.StreamHandler):
 
 
 # This itens won't be added as extra information in the stackdriver logging record
-_items_to_pop_from_record_copy = [
+_items_to_pop_from_record_copy = frozenset([
     'relativeCreated',
     'process',
     'module',
@@ -50,26 +53,31 @@ _items_to_pop_from_record_copy = [
     'pathname',
     'exc_info',
     'levelname'
-]
+])
 
+# Translation table that keeps messages on a single line and free of double quotes
+_message_translation = {ord("\""): "'", ord("\n"): "; "}
 
-def _is_jsonable(x):
-    try:
-        json.dumps(x)
-        return True
-    except (TypeError, OverflowError):
-        return False
+
+def _dumps(payload):
+    """Serialize payload to JSON using orjson when available, writing values JSON can't hold as their repr."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, default=repr, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(payload, default=repr, separators=(",", ":"))
 
 
 def _format_stackdriver_json(record, message):
     """Helper to format a LogRecord in in Stackdriver fluentd format."""
-    subsecond, second = math.modf(record.created)
+    second, nanos = divmod(int(record.created * 1e9), 1000000000)
 
     payload = {
-        'message': message.replace("\"", "'").replace("\n", "; "),
+        'message': message.translate(_message_translation),
         'timestamp': {
-            'seconds': int(second),
-            'nanos': int(subsecond * 1e9),
+            'seconds': second,
+            'nanos': nanos,
         },
         'thread': record.thread,
         'severity': record.levelname,
@@ -78,18 +86,13 @@ def _format_stackdriver_json(record, message):
         'line': record.lineno,
     }
 
-    extra_info = dict(record.__dict__)
-    to_pop = []
-    for item in extra_info:
-        if item in _items_to_pop_from_record_copy or not _is_jsonable(extra_info[item]):
-            to_pop.append(item)
-    for item in to_pop:
-        extra_info.pop(item)
-
-    payload.update(extra_info)
+    payload.update(
+        (item, value) for item, value in record.__dict__.items()
+        if item not in _items_to_pop_from_record_copy
+    )
 
     if record.exc_text is not None:
         # Add exception info if it exists
         payload['exception'] = record.exc_text.replace("\"", "'").split("\n")
 
-    return json.dumps(payload)
+    return _dumps(payload)
@@ -4,7 +4,7 @@
 Copyright (c) SambaTech. All rights reserved.
 
 created_at: 06-JUN-2018
-updated_at: 10-JUL-2018
+updated_at: 15-OCT-2026
 
 Task consumer for async and reliable job executions.
 
@@ -28,8 +28,9 @@ It is possible to define custom values for the maximum of times a work can fail
 or throw an error.
 """
 import warnings
+import contextlib
 import random
-import math
+import threading
 from samba_chassis import logging, config
 from samba_chassis.tasks.execs import TaskExecution
 from samba_chassis.tasks.queues import QueueHandler
@@ -37,16 +38,33 @@ from samba_chassis.tasks.consumers import TaskConsumer
 
 _logger = logging.getLogger(__name__)
 
+# Longest retry delay exponential progressions grow to, SQS's maximum visibility timeout (12 hours)
+_MAX_DELAY = 43200
+# Retries whose delays are precomputed for progressions without randomness
+_DELAY_TABLE_SIZE = 100
+
 
 class Task(object):
     """Task representation that defines a task and its operations."""
 
+    __slots__ = ("name", "func", "queue_handler", "max_retries", "on_fail", "wait_time", "wait_progression",
+                 "_delay_fn", "_delay_table")
+
     _progressions = {
         "NONE": lambda wait_time, retries: 0 if retries == 0 else int(wait_time),
-        "GEOMETRIC": lambda wait_time, retries: int(wait_time * math.pow(retries, 2)),
+        "GEOMETRIC": lambda wait_time, retries: int(wait_time * retries * retries),
         "ARITHMETIC": lambda wait_time, retries: int(wait_time * retries),
-        "RANDOM": lambda wait_time, retries: 0 if retries == 0 else int(wait_time * random.uniform(0.5, 2.0))
+        "RANDOM": lambda wait_time, retries: 0 if retries == 0 else int(wait_time * random.uniform(0.5, 2.0)),
+        # Full jitter variants, spreading the retries of tasks that failed together
+        "GEOMETRIC_JITTER": lambda wait_time, retries: int(random.uniform(0, wait_time * retries * retries)),
+        "ARITHMETIC_JITTER": lambda wait_time, retries: int(random.uniform(0, wait_time * retries)),
+        # Doubling delays, capped at _MAX_DELAY
+        "EXPONENTIAL": lambda wait_time, retries:
+            0 if retries == 0 else int(min(wait_time * (1 << (retries - 1)), _MAX_DELAY)),
+        "EXPONENTIAL_JITTER": lambda wait_time, retries:
+            0 if retries == 0 else int(random.uniform(0, min(wait_time * (1 << (retries - 1)), _MAX_DELAY)))
     }
+    _random_progressions = frozenset(["RANDOM", "GEOMETRIC_JITTER", "ARITHMETIC_JITTER", "EXPONENTIAL_JITTER"])
 
     @staticmethod
     def send(task_name, attr, queue_handler, delay=0, exec_id=None, when=None, **kwargs):
@@ -84,6 +102,13 @@ class Task(object):
             _logger.error("INVALID_PROGRESSION {}".format(wait_progression))
             raise ValueError("INVALID_PROGRESSION {}".format(wait_progression))
         self.wait_progression = wait_progression
+        self._delay_fn = self._progressions[wait_progression]
+        # Deterministic delays only depend on the retry number, so look the usual ones up
+        self._delay_table = None
+        if wait_progression not in self._random_progressions:
+            self._delay_table = tuple(
+                self._delay_fn(wait_time, retries) for retries in range(min(max_retries, _DELAY_TABLE_SIZE) + 1)
+            )
 
     def get_delay(self, retries=0):
         """
@@ -92,7 +117,9 @@ class Task(object):
         :param retries: Number of retries already done.
         :return: Next delay.
         """
-        return self._progressions[self.wait_progression](self.wait_time, retries)
+        if self._delay_table is not None and 0 <= retries < len(self._delay_table):
+            return self._delay_table[retries]
+        return self._delay_fn(self.wait_time, retries)
 
     def issue(self, attr, delay=0, exec_id=None, when=None):
         """
@@ -116,7 +143,7 @@ class Task(object):
         else:
             self.send(self.on_fail, attr, self.queue_handler)
 
-    def run(self, attr, retries=0, job_id="unknown", job_name="unknown"):
+    def run(self, attr, retries=0, job_id="unknown", job_name="unknown", executor=None):
         """
         Run task.
 
@@ -124,20 +151,27 @@ class Task(object):
         :param retries: Number of retries already performed in this command.
         :param job_id: Job id for service logging.
         :param job_name: Job name for service logging.
+        :param executor: Executor to run the task function on. If None, the function is called in place.
         :return: True if successful, false otherwise.
         """
         if int(retries) >= self.max_retries:
-            try:
-                _logger.error("TASK_FAILED {}: {}/{} retries".format(self.name, retries, self.max_retries),
-                              job_id=job_id, job_name=job_name)
-                self.issue_fail(attr)
-            finally:
-                return True
+            _logger.error("TASK_FAILED {}: {}/{} retries".format(self.name, retries, self.max_retries),
+                          job_id=job_id, job_name=job_name)
+            if self.on_fail is not None:
+                try:
+                    self.issue_fail(attr)
+                except Exception:
+                    _logger.exception("ERROR_ISSUING_ON_FAIL_TASK {}".format(self.name),
+                                      job_id=job_id, job_name=job_name)
+            return True
 
         try:
-            res = self.func(attr)
+            if executor is None:
+                res = self.func(attr)
+            else:
+                res = executor.submit(self.func, attr).result()
             return res if res is not None else True
-        except:
+        except Exception:
             _logger.exception("ERROR_RUNNING_TASK {}".format(self.name), job_id=job_id, job_name=job_name)
             return False
 
@@ -155,52 +189,98 @@ class ConfigurationError(RuntimeError):
 _consumer = None
 _consumer_p = None
 _queue_pool = {}
+_queue_pool_lock = threading.Lock()
 _tasks = {}
+# Tasks registered before the module was configured, registered by config()
+_pending_tasks = []
+# Warnings already issued by _warn_once
+_warned = set()
+# Runs collected by each thread's deferred_runs block
+_deferred = threading.local()
 _config = None
 
 
 #
 # Config Layout
 #
+def _is_lower(x):
+    """Config rule: value is lower case."""
+    return x == x.lower()
+
+
+def _is_positive(x):
+    """Config rule: value is greater than zero."""
+    return x > 0
+
+
+def _is_not_negative(x):
+    """Config rule: value is zero or greater."""
+    return x >= 0
+
+
+def _is_pool_type(x):
+    """Config rule: value is a consumer pool type."""
+    return x in TaskConsumer.pool_types
+
+
+# Consumer settings left off the consumer class call when unchanged, matching TaskConsumer's defaults
+_default_pool_type = "thread"
+_default_scaling_interval = 10
+
 config_layout = config.ConfigLayout({
     "task_pool": config.ConfigItem(
         type=str,
-        rules=[lambda x: True if x.lower() == x else False]
+        rules=[_is_lower]
     ),
     "task_timeout": config.ConfigItem(
         default=120,
         type=int,
-        rules=[lambda x: True if x > 0 else False]
+        rules=[_is_positive]
     ),
     "workers": config.ConfigItem(
         default=3,
         type=int,
-        rules=[lambda x: True if x > 0 else False]
+        rules=[_is_positive]
     ),
     "unknown_tasks_retries": config.ConfigItem(
         default=50,
         type=int,
-        rules=[lambda x: True if x > 0 else False]
+        rules=[_is_positive]
     ),
     "unknown_tasks_delay": config.ConfigItem(
         default=10,
         type=int,
-        rules=[lambda x: True if x > 0 else False]
+        rules=[_is_positive]
     ),
     "max_workers": config.ConfigItem(
         default=6,
         type=int,
-        rules=[lambda x: True if x > 0 else False]
+        rules=[_is_positive]
     ),
     "scale_factor": config.ConfigItem(
         default=100,
         type=int,
-        rules=[lambda x: True if x > 0 else False]
+        rules=[_is_positive]
     ),
     "when_window": config.ConfigItem(
         default=300,
         type=int,
-        rules=[lambda x: True if x > 0 else False]
+        rules=[_is_positive]
+    ),
+    "scaling_interval": config.ConfigItem(
+        default=_default_scaling_interval,
+        type=int,
+        rules=[_is_positive]
+    ),
+    "max_receive_count": config.ConfigItem(
+        default=0,
+        type=int,
+        rules=[_is_not_negative]
+    ),
+    "pool_type": config.ConfigItem(
+        default=_default_pool_type,
+        type=str,
+        rules=[_is_pool_type]
     ),
 })
 
@@ -214,7 +294,13 @@ def config(config_object=None):
 
     :param config_object: A configuration object. It must have task_pool, optional parameters are
     task_timeout (default 120), workers (default 3), unknown_tasks_retries (default 50),
-    unknown_tasks_delay (default 10), max_workers (default 10), scale_factor (default 100).
+    unknown_tasks_delay (default 10), max_workers (default 10), scale_factor (default 100),
+    when_window (default 300), pool_type (default "thread", or "process" for CPU-bound tasks),
+    scaling_interval (default 10, seconds between queue length checks) and max_receive_count (default 0, off).
+    When max_receive_count is set, the task pool queue gets a dead letter queue that takes messages received
+    that many times, and unknown tasks are left to it. Every receive counts: retries, each postpone of a task
+    whose when is ahead (at most 5 hours at a time) and each release of received messages when the consumer
+    stops. It must be above every task's max_retries plus the postpones of the furthest when used.
     """
     global _config
     if config_object is None:
@@ -224,9 +310,17 @@ def config(config_object=None):
     # Configure module
     # Create queue handler pool with its names.
     queue_name = _config.task_pool
-    _queue_pool[queue_name] = _queue_class(queue_name, _config.task_timeout)
+    # Only pass max_receive_count when set, so queue classes without it keep working
+    queue_args = (queue_name, _config.task_timeout)
+    if _config.max_receive_count:
+        queue_args += (_config.max_receive_count,)
+    _queue_pool[queue_name] = _queue_class(*queue_args)
 
-    _logger.debug("Configured tasks module with queue {} and attributes {}".format(queue_name, _config))
+    _logger.debug("Configured tasks module with queue %s and attributes %s", queue_name, _config)
+    # Register tasks set before configuration
+    if _pending_tasks:
+        set_tasks(list(_pending_tasks))
+        del _pending_tasks[:]
 
 
 def start_consumer(config_object=None):
@@ -237,25 +331,35 @@ def start_consumer(config_object=None):
 
     global _consumer
     _logger.debug("Starting consumer")
+    # Snapshot the config so a concurrent config() can't mix two of them
+    conf = _config
     # Evaluate consumer
-    if _config is None or not hasattr(_config, "task_pool"):
+    if conf is None or not hasattr(conf, "task_pool"):
         _logger.error("UNCONFIGURED_TASK_MODULE")
         raise ConfigurationError("UNCONFIGURED_TASK_MODULE")
     if _consumer is not None and _consumer.status == _consumer_class.statuses.RUNNING:
-        _logger.warn("CONSUMER_ALREADY_RUNNING")
-        raise warnings.warn("CONSUMER_ALREADY_RUNNING")
+        _logger.warning("CONSUMER_ALREADY_RUNNING")
+        warnings.warn("CONSUMER_ALREADY_RUNNING")
+        return
     # Start consumer
-    queue_name = _config.task_pool
+    queue_name = conf.task_pool
     if _consumer is None:
+        # Only pass pool_type and scaling_interval when changed, so consumer classes without them keep working
+        consumer_kwargs = {}
+        if conf.pool_type != _default_pool_type:
+            consumer_kwargs["pool_type"] = conf.pool_type
+        if conf.scaling_interval != _default_scaling_interval:
+            consumer_kwargs["scaling_interval"] = conf.scaling_interval
         _consumer = _consumer_class(
             _queue_pool[queue_name],
             _tasks,
-            workers=_config.workers,
-            unknown_tasks_retries=_config.unknown_tasks_retries,
-            unknown_tasks_delay=_config.unknown_tasks_delay,
-            max_workers=_config.max_workers,
-            scale_factor=_config.scale_factor,
-            when_window=_config.when_window
+            workers=conf.workers,
+            unknown_tasks_retries=conf.unknown_tasks_retries,
+            unknown_tasks_delay=conf.unknown_tasks_delay,
+            max_workers=conf.max_workers,
+            scale_factor=conf.scale_factor,
+            when_window=conf.when_window,
+            **consumer_kwargs
         )
     _consumer.start()
 
@@ -294,15 +398,54 @@ def set_task(task_name, task_function, max_retries=10, on_fail=None, wait_time=1
     :param wait_time: Time to wait before first retry.
     :param wait_progression: Progression mode of wait_time after first retry.
     """
-    _logger.debug("Registering task {}".format(task_name))
-    # Validate arguments
-    if task_name in _tasks:
-        _logger.warn("REGISTERED_TASK_OVERWRITTEN: {}".format(task_name))
-        warnings.warn("REGISTERED_TASK_OVERWRITTEN: {}".format(task_name))
-    # Register task
-    queue_name = _config.task_pool
-    _tasks[task_name] = _task_class(task_name, task_function, _queue_pool[queue_name],
-                                    max_retries, on_fail, wait_time, wait_progression)
+    set_tasks([(task_name, task_function, max_retries, on_fail, wait_time, wait_progression)])
+
+
+def set_tasks(task_specs):
+    """
+    Register several tasks, resolving the task pool queue once.
+
+    Tasks registered before the module is configured are kept and registered by config().
+    :param task_specs: Iterable of set_task argument tuples, (task_name, task_function) optionally followed by
+    max_retries, on_fail, wait_time and wait_progression.
+    """
+    if _config is None:
+        task_specs = list(task_specs)
+        for task_spec in task_specs:
+            _check_task_spec(task_spec)
+        _pending_tasks.extend(task_specs)
+        return
+    queue_handler = _queue_pool[_config.task_pool]
+    new_tasks = {}
+    for task_spec in task_specs:
+        _logger.debug("Registering task %s", task_spec[0])
+        task_name = task_spec[0]
+        # Validate arguments
+        if task_name in _tasks or task_name in new_tasks:
+            _warn_once("REGISTERED_TASK_OVERWRITTEN: {}".format(task_name))
+        new_tasks[task_name] = _task_class(task_name, task_spec[1], queue_handler, *task_spec[2:])
+    # Register tasks
+    _tasks.update(new_tasks)
+
+
+def _check_task_spec(task_spec):
+    """Raise the error registering a task spec would, so a deferred registration fails where it is made."""
+    if len(task_spec) < 2:
+        raise TypeError("INVALID_TASK_SPEC {}".format(task_spec))
+    if isinstance(_task_class, type) and issubclass(_task_class, Task) and len(task_spec) > 5:
+        wait_progression = task_spec[5]
+        if wait_progression not in _task_class._progressions:
+            _logger.error("INVALID_PROGRESSION {}".format(wait_progression))
+            raise ValueError("INVALID_PROGRESSION {}".format(wait_progression))
+
+
+def _warn_once(message):
+    """Log and issue a warning, only the first time the message comes up."""
+    if message in _warned:
+        return
+    _warned.add(message)
+    _logger.warning(message)
+    warnings.warn(message)
 
 
 def task(max_retries=10, on_fail=None, wait_time=10, wait_progression="NONE"):
@@ -330,26 +473,112 @@ def run(task_name, task_attr, task_pool=None, when=None, **kwargs):
     The default is the current service's name.
     :param when: Datetime that tells when can the task execute.
     """
-    # Define service and queue handler
-    if task_pool is None:
-        task_pool = _config.task_pool
-
-    strict = True
-    if task_pool != _config.task_pool:
-        strict = False
-
-    queue_name = task_pool
-    if queue_name not in _queue_pool:
-        _queue_pool[queue_name] = _queue_class(queue_name)
-    # Issue task
-    if strict and task_name not in _tasks:
-        _logger.error(
-            "STRICT_TASK_NOT_REGISTERED: {}".format(task_name),
-            job_id=kwargs.get("job_id", "unknown"),
-            job_name=kwargs.get("job_name", "unknown")
-        )
-        raise RuntimeError("STRICT_TASK_NOT_REGISTERED: {}".format(task_name))
-    _task_class.send(task_name, task_attr, _queue_pool[queue_name], when=when, **kwargs)
+    if task_pool is None or task_pool == _config.task_pool:
+        # Own pool: the registered task already holds its queue handler
+        task = _tasks.get(task_name)
+        if task is None:
+            _logger.error(
+                "STRICT_TASK_NOT_REGISTERED: {}".format(task_name),
+                job_id=kwargs.get("job_id", "unknown"),
+                job_name=kwargs.get("job_name", "unknown")
+            )
+            raise RuntimeError("STRICT_TASK_NOT_REGISTERED: {}".format(task_name))
+        queue_handler = task.queue_handler
+    else:
+        # Another service's pool
+        queue_handler = _pool_queue_handler(task_pool)
+    # Issue task, or leave it for the enclosing deferred_runs block
+    deferred = getattr(_deferred, "runs", None)
+    if deferred is not None:
+        deferred.append((queue_handler, (task_name, task_attr, 0, None, when), kwargs))
+        return
+    _task_class.send(task_name, task_attr, queue_handler, when=when, **kwargs)
+
+
+@contextlib.contextmanager
+def deferred_runs():
+    """
+    Collect the run calls made by this thread inside the block and send them in batches at its end.
+
+    Unregistered tasks still raise from run itself. Nested blocks are sent by the outermost one.
+    Raises RuntimeError at the end of the block if some runs could not be sent.
+    """
+    if getattr(_deferred, "runs", None) is not None:
+        yield
+        return
+    _deferred.runs = runs = []
+    try:
+        yield
+    finally:
+        _deferred.runs = None
+        failed = _send_deferred(runs)
+    if failed:
+        _logger.error("DEFERRED_RUNS_NOT_SENT: {}/{}".format(len(failed), len(runs)))
+        raise RuntimeError("DEFERRED_RUNS_NOT_SENT: {}/{}".format(len(failed), len(runs)))
+
+
+def _send_deferred(runs):
+    """Send (queue_handler, send, kwargs) runs grouped by handler and kwargs, returning the sends that failed."""
+    groups = []
+    for queue_handler, send, kwargs in runs:
+        for group in groups:
+            if group[0] is queue_handler and group[1] == kwargs:
+                group[2].append(send)
+                break
+        else:
+            groups.append((queue_handler, kwargs, [send]))
+    failed = []
+    for queue_handler, kwargs, sends in groups:
+        failed.extend(queue_handler.send_many(sends, **kwargs))
+    return failed
+
+
+def run_many(runs, task_pool=None, **kwargs):
+    """
+    Send several run task messages to queue, in batches of up to 10 messages per call.
+
+    :param runs: Iterable of (task_name, task_attr) tuples, optionally followed by when.
+    :param task_pool: The name set for the task pool where all tasks come from.
+    The default is the current service's name.
+    :return: List of the runs that could not be sent.
+    """
+    runs = list(runs)
+    if task_pool is None or task_pool == _config.task_pool:
+        # Own pool: every task must be registered, and is sent through its queue handler as run does
+        queue_handlers = []
+        for task_run in runs:
+            task = _tasks.get(task_run[0])
+            if task is None:
+                _logger.error(
+                    "STRICT_TASK_NOT_REGISTERED: {}".format(task_run[0]),
+                    job_id=kwargs.get("job_id", "unknown"),
+                    job_name=kwargs.get("job_name", "unknown")
+                )
+                raise RuntimeError("STRICT_TASK_NOT_REGISTERED: {}".format(task_run[0]))
+            queue_handlers.append(task.queue_handler)
+    else:
+        # Another service's pool
+        queue_handlers = [_pool_queue_handler(task_pool)] * len(runs)
+    sends = [(task_run[0], task_run[1], 0, None, task_run[2] if len(task_run) > 2 else None) for task_run in runs]
+    failed = set(id(send) for send in _send_deferred(
+        [(queue_handler, send, kwargs) for queue_handler, send in zip(queue_handlers, sends)]
+    ))
+    return [task_run for task_run, send in zip(runs, sends) if id(send) in failed]
+
+
+def _pool_queue_handler(task_pool):
+    """Return the queue handler for a task pool, creating it only once even with concurrent callers."""
+    queue_handler = _queue_pool.get(task_pool)
+    if queue_handler is None:
+        with _queue_pool_lock:
+            queue_handler = _queue_pool.get(task_pool)
+            if queue_handler is None:
+                queue_handler = _queue_pool[task_pool] = _queue_class(task_pool)
+    return queue_handler
+
+
+# Consumer statuses that count as ready
+_ready_statuses = frozenset((TaskConsumer.statuses.STOPPING, TaskConsumer.statuses.RUNNING))
 
 
 def ready():
@@ -363,11 +592,13 @@ def ready():
     if _consumer is None:
         _logger.error("TASK_CONSUMER_IS_NONE")
         r["TASK_CONSUMER"] = "ERROR"
-    elif _consumer.get_status() not in [TaskConsumer.statuses.STOPPING, TaskConsumer.statuses.RUNNING]:
-        _logger.error("TASK_CONSUMER_BAD_STATUS {}".format(_consumer.get_status()))
-        r["TASK_CONSUMER"] = "ERROR"
     else:
-        r["TASK_CONSUMER"] = "OK"
+        status = _consumer.get_status()
+        if status not in _ready_statuses:
+            _logger.error("TASK_CONSUMER_BAD_STATUS {}".format(status))
+            r["TASK_CONSUMER"] = "ERROR"
+        else:
+            r["TASK_CONSUMER"] = "OK"
 
     return r
 
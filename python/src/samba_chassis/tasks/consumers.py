@@ -4,18 +4,56 @@
 Copyright (c) SambaTech. All rights reserved.
 
 created_at: 10-JUL-2018
-updated_at: 19-DEC-2018
+updated_at: 15-OCT-2026
 """
 import threading
+import queue
+import collections
 import json
 import time
 import math
-from datetime import datetime, timedelta
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from samba_chassis.tasks.execs import TaskExecution
+from samba_chassis.tasks.queues import _WHEN_FORMAT
 
 from samba_chassis import logging
 _logger = logging.getLogger(__name__)
 
+# Shared defaults for message attribute lookups, so none are allocated per message
+_EMPTY = {}
+_UNKNOWN = {"StringValue": "unknown"}
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _message_when(message):
+    """
+    Return a message's when as UTC epoch seconds.
+
+    Reads when_epoch first and falls back to parsing the when string sent by older versions.
+    Messages without a when attribute, not sent through QueueHandler.send, return None.
+    """
+    attributes = message.message_attributes
+    when = attributes.get("when_epoch") or attributes.get("when")
+    if when is None:
+        return None
+    value = when["StringValue"]
+    try:
+        return int(value)
+    except ValueError:
+        return (_parse_when(value) - _EPOCH).total_seconds()
+
+
+def _parse_when(value):
+    """Parse a "%d/%m/%y %H:%M:%S" datetime string by slicing its fixed width fields, without strptime."""
+    if len(value) != 17:
+        return datetime.strptime(value, _WHEN_FORMAT)
+    year = int(value[6:8])
+    # Same century rule as strptime's %y
+    year += 2000 if year < 69 else 1900
+    return datetime(year, int(value[3:5]), int(value[0:2]), int(value[9:11]), int(value[12:14]), int(value[15:17]))
+
 
 def _enum(*sequential, **named):
     """
@@ -33,10 +71,24 @@ class TaskConsumer(object):
     """Consumer that runs tasks and monitor their execution."""
 
     statuses = _enum("STOPPED", "STOPPING", "RUNNING", "ERROR")
+    pool_types = ("thread", "process")
+
+    # Status state machine, {(status, event): new status}. Pairs not listed keep the current status.
+    _transitions = {
+        (statuses.STOPPED, "start"): statuses.RUNNING,
+        (statuses.STOPPING, "start"): statuses.RUNNING,
+        (statuses.RUNNING, "stop"): statuses.STOPPING,
+        (statuses.STOPPED, "force_stop"): statuses.STOPPED,
+        (statuses.STOPPING, "force_stop"): statuses.STOPPED,
+        (statuses.RUNNING, "force_stop"): statuses.STOPPED,
+        (statuses.ERROR, "force_stop"): statuses.STOPPED,
+        (statuses.STOPPING, "drained"): statuses.STOPPED
+    }
 
     def __init__(self, queue_handler, task_map, workers=1, unknown_tasks_retries=10,
                  unknown_tasks_delay=10, task_execution_class=TaskExecution, max_workers=None,
-                 scale_factor=100, when_window=60):
+                 scale_factor=100, when_window=60, pool_type="thread", receivers=None,
+                 scaling_interval=10, prefetch_multiplier=1):
         """
         Initiate consumer.
 
@@ -48,7 +100,16 @@ class TaskConsumer(object):
         :param task_execution_class: Class to use for task exec commands.
         :param max_workers: Max number of workers for dynamic scaling. If None, scaling is off.
         :param when_window: Time in seconds to offset datetime defined executions.
+        :param pool_type: Where task functions run, "thread" or "process" (for CPU-bound tasks).
+        :param receivers: Number of threads receiving messages. If None, one for every 10 workers.
+        :param scaling_interval: Seconds between queue length checks for scaling.
+        :param prefetch_multiplier: Messages kept received per worker, counting the ones running.
+        Above 1, free workers pick up buffered messages without waiting for a receive call, but
+        buffered messages use up their visibility timeout while they wait.
         """
+        if pool_type not in self.pool_types:
+            _logger.error("INVALID_POOL_TYPE {}".format(pool_type))
+            raise ValueError("INVALID_POOL_TYPE {}".format(pool_type))
         self.queue_handler = queue_handler
         self.task_map = task_map
         self.workers = workers
@@ -57,6 +118,9 @@ class TaskConsumer(object):
         self.unknown_tasks_retries = unknown_tasks_retries
         self.unknown_tasks_delay = unknown_tasks_delay
         self.scale_factor = scale_factor
+        self.scaling_interval = scaling_interval
+        self._scaling_thread = None
+        self._scaling_wakeup = threading.Event()
 
         self._task_execution_class = task_execution_class
 
@@ -69,23 +133,46 @@ class TaskConsumer(object):
         self._on_going_tasks = {}
         self.when_window = when_window
 
+        self.pool_type = pool_type
+        self._executor = None
+        self._process_pool = None
+        self._wakeup = threading.Event()
+
+        if receivers is None:
+            receivers = max(1, max(max_workers or 0, workers) // 10)
+        self.receivers = receivers
+        self.prefetch_multiplier = prefetch_multiplier
+        self._receiver_threads = []
+        self._receive_lock = threading.Lock()
+        self._received = queue.Queue()
+        self._receiving = 0
+        self._capacity = threading.Event()
+
+        self._extender_thread = None
+        # Plain deques behind one condition, so a whole pass of extensions moves across in one lock round
+        self._extensions = collections.deque()
+        self._extensions_cv = threading.Condition()
+        self._failed_extensions = collections.deque()
+
     def start(self):
         """Start consumer."""
         _logger.info("STARTING_TASK_CONSUMER")
-        if self.status == self.statuses.STOPPED:
-            if self.consumer_thread is not None and self.consumer_thread.is_alive():
-                # wait for thread to die
-                while self.consumer_thread.is_alive():
-                    time.sleep(1)
-
-            self.status = self.statuses.RUNNING
+        if self.status == self.statuses.STOPPED and self.consumer_thread is not None:
+            # wait for thread to die
+            while self.consumer_thread.is_alive():
+                time.sleep(1)
+
+        if self._transition("start") == self.statuses.STOPPED:
+            self._start_workers()
+            self._start_receivers()
+            self._extender_thread = threading.Thread(target=self._extender_loop)
+            self._extender_thread.start()
+            if self.max_workers is not None:
+                self._scaling_wakeup.clear()
+                self._scaling_thread = threading.Thread(target=self._scaling_loop)
+                self._scaling_thread.start()
             self.consumer_thread = threading.Thread(target=self.loop)
             self.consumer_thread.start()
-            return
-
-        with self._status_lock:
-            if self.status == self.statuses.STOPPING:
-                self.status = self.statuses.RUNNING
 
     def stop(self, force=False):
         """
@@ -94,33 +181,205 @@ class TaskConsumer(object):
         :param force: Flag that determines whether to stop immediately or wait for current task to stop.
         """
         _logger.info("STOPPING_TASK_CONSUMER")
-        if force:
-            self.status = self.statuses.STOPPED
-        else:
-            self.status = self.statuses.STOPPING
+        self._transition("force_stop" if force else "stop")
+        self._wakeup.set()
+
+    def _transition(self, event):
+        """
+        Apply a status transition atomically.
+
+        :param event: Event name, such as "start" or "stop".
+        :return: Status before the transition.
+        """
+        with self._status_lock:
+            status = self.status
+            self.status = self._transitions.get((status, event), status)
+        return status
 
     def loop(self):
         """Main loop for monitoring thread."""
-        _logger.debug("Entering loop with status {}".format(self.status))
+        _logger.debug("Entering loop with status %s", self.status)
         while self.status != self.statuses.STOPPED:
+            self._wakeup.clear()
             with self._on_going_lock:
-                _logger.debug("{} tasks executing".format(len(self._on_going_tasks)))
+                _logger.debug("%s tasks executing", len(self._on_going_tasks))
                 # Monitor and process ongoing tasks.
                 self._process_on_going_tasks()
-                # Stop consumer if it is stopping and there are no more on going tasks.
-                with self._status_lock:
-                    if len(self._on_going_tasks) == 0 and self.status == self.statuses.STOPPING:
-                        self.status = self.statuses.STOPPED
-                # Check if should scale number of workers
-                self._process_scaling()
-                # Get new tasks if consumer is running and there are less on going tasks than max.
-                if len(self._on_going_tasks) < self.workers and self.status == self.statuses.RUNNING:
-                    tasks = self._get_new_tasks(self.workers - len(self._on_going_tasks))
+                drained = not self._on_going_tasks
+            # Stop consumer if it is stopping and there are no more on going tasks,
+            # once the last deletions and visibility changes are sent.
+            if drained and self.status == self.statuses.STOPPING:
+                self._flush_batches()
+                self._transition("drained")
+                continue
+            # Only this thread changes the on going tasks, so reading their count here is safe.
+            # Get new tasks if consumer is running and there are less on going tasks than max.
+            free_workers = self.workers - len(self._on_going_tasks)
+            if free_workers > 0 and self.status == self.statuses.RUNNING:
+                tasks = self._get_new_tasks(free_workers)
+                with self._on_going_lock:
                     self._run_tasks(tasks)
-            # Sleep for one second
-            time.sleep(1)
+            # Let the receivers fetch messages for the workers that are free now
+            self._capacity.set()
+            # Send this iteration's message deletions and visibility changes
+            self._flush_batches()
+            # Sleep until a task finishes or, at most, until the next deadline check
+            self._wakeup.wait(timeout=self._next_wakeup_seconds())
         _logger.debug("Getting out of loop")
-        self.status = self.statuses.STOPPED
+        self._flush_batches()
+        self._stop_workers()
+        self._transition("force_stop")
+        self._capacity.set()
+        self._scaling_wakeup.set()
+        with self._extensions_cv:
+            self._extensions_cv.notify()
+        # A restart waits for this thread, so none of this run's threads outlive it
+        self._join_threads()
+        self._release_received()
+
+    def _join_threads(self):
+        """Wait for the receiver, extender and scaling threads to see the consumer stopped and exit."""
+        for thread in self._receiver_threads + [self._extender_thread, self._scaling_thread]:
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        self._receiver_threads = []
+        self._extender_thread = None
+        self._scaling_thread = None
+
+    def _next_wakeup_seconds(self):
+        """Return how long the loop can sleep before an on going task reaches its deadline (0.05 to 1 second)."""
+        with self._on_going_lock:
+            deadlines = [task_exec.deadline_epoch for task_exec in self._on_going_tasks.values()]
+        if not deadlines:
+            return 1.0
+        seconds = min(deadlines) - time.time()
+        return min(max(seconds, 0.05), 1.0)
+
+    def _flush_batches(self):
+        """Send the message deletions and visibility changes queued in the queue handler."""
+        try:
+            self.queue_handler.flush_deletes()
+        except Exception:
+            _logger.exception("FLUSH_DELETES_ERROR")
+        try:
+            self.queue_handler.flush_postpones()
+        except Exception:
+            _logger.exception("FLUSH_POSTPONES_ERROR")
+
+    def _start_workers(self):
+        """Create the worker pools, big enough for the maximum number of concurrent tasks."""
+        size = max(self.max_workers or 0, self.workers)
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        if self.pool_type == "process":
+            self._process_pool = ProcessPoolExecutor(max_workers=size)
+
+    def _stop_workers(self):
+        """Shut the worker pools down, letting running tasks finish."""
+        for pool in (self._executor, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False)
+        self._executor = None
+        self._process_pool = None
+
+    def _execute(self, task_exec):
+        """Execute a task on a worker thread, waking the loop up when it is done."""
+        try:
+            task_exec.execute(self._process_pool)
+        except Exception:
+            _logger.exception("TASK_EXECUTION_ERROR: {} {}".format(task_exec.task.name, task_exec.exec_id),
+                              job_id=task_exec.job_id, job_name=task_exec.job_name)
+        finally:
+            task_exec.finished = True
+            self._wakeup.set()
+
+    def _start_receivers(self):
+        """Start the threads that receive messages from the queue."""
+        self._receiver_threads = [threading.Thread(target=self._receive_loop) for _ in range(self.receivers)]
+        for receiver in self._receiver_threads:
+            receiver.start()
+
+    def _reserve_receive(self):
+        """Return how many messages a receiver may fetch (at most 10), counting them as being received."""
+        with self._receive_lock:
+            if self.status != self.statuses.RUNNING:
+                return 0
+            num = self.workers * self.prefetch_multiplier - len(self._on_going_tasks) - \
+                self._received.qsize() - self._receiving
+            num = min(num, 10)
+            if num > 0:
+                self._receiving += num
+            return num
+
+    def _receive_loop(self):
+        """Receiver thread main loop: fetch messages for free workers until the consumer stops."""
+        while self.status != self.statuses.STOPPED:
+            num = self._reserve_receive()
+            if num <= 0:
+                # Wait for the loop to free workers
+                self._capacity.wait(timeout=1.0)
+                self._capacity.clear()
+                continue
+            try:
+                messages = self.queue_handler.retrieve(num)
+            except Exception:
+                _logger.exception("RETRIEVE_ERROR")
+                messages = []
+                time.sleep(1)
+            received_at = datetime.utcnow()
+            with self._receive_lock:
+                self._receiving -= num
+                if self.status == self.statuses.STOPPED:
+                    self._release(messages)
+                    return
+                for message in messages:
+                    self._received.put((message, received_at))
+            if messages:
+                self._wakeup.set()
+
+    def _release_received(self):
+        """Make messages received but not yet executed visible in the queue again."""
+        with self._receive_lock:
+            messages = []
+            while not self._received.empty():
+                messages.append(self._received.get_nowait()[0])
+            self._release(messages)
+
+    def _release(self, messages):
+        """Make messages visible in the queue again."""
+        for message in messages:
+            try:
+                self.queue_handler.postpone(message, 0)
+            except Exception:
+                _logger.exception("RELEASE_ERROR")
+
+    def _extender_loop(self):
+        """Extender thread main loop: change on going tasks' message visibility in batches of up to 10."""
+        while self.status != self.statuses.STOPPED:
+            with self._extensions_cv:
+                if not self._extensions:
+                    self._extensions_cv.wait(timeout=1.0)
+                extensions = list(self._extensions)
+                self._extensions.clear()
+            for i in range(0, len(extensions), 10):
+                self._extend(extensions[i:i + 10])
+
+    def _extend(self, batch):
+        """Change the visibility of a batch of on going tasks' messages, handing failures back to the loop."""
+        try:
+            failed = self.queue_handler.postpone_batch([(task_exec.message, timeout) for task_exec, timeout in batch])
+        except Exception:
+            _logger.exception("EXTEND_ERROR")
+            failed = range(len(batch))
+        for i in failed:
+            self._failed_extensions.append(batch[i][0])
+        if failed:
+            self._wakeup.set()
+
+    def _scaling_loop(self):
+        """Scaling thread main loop: check the queue length every scaling interval until the consumer stops."""
+        while self.status != self.statuses.STOPPED:
+            self._process_scaling()
+            self._scaling_wakeup.wait(timeout=self.scaling_interval)
 
     def _process_scaling(self):
         """Scale number of workers if enabled and queue len is greater or lower than limit."""
@@ -131,28 +390,45 @@ class TaskConsumer(object):
             upper_limit = self.workers*self.scale_factor + int(self.scale_factor/2)
             lower_limit = self.workers * self.scale_factor - int(self.scale_factor / 2)
             if num_tasks > upper_limit and self.workers < self.max_workers:
-                self.workers += 1
+                # Go straight to the backlog's worker count so spikes drain without one interval per worker,
+                # scaling down stays one worker at a time
+                self.workers = min(self.max_workers, max(self.workers + 1, self._target_workers(num_tasks)))
             elif num_tasks < lower_limit and self.workers > self.def_workers:
                 self.workers -= 1
-        except:
+        except Exception:
             _logger.exception("SCALING_ERROR")
 
+    def _target_workers(self, num_tasks):
+        """Return the number of workers that keeps about scale_factor queued tasks per worker."""
+        return (num_tasks + self.scale_factor // 2) // self.scale_factor
+
     def _process_on_going_tasks(self):
         """Monitor and process on going tasks."""
         bye_bye_tasks = []
-        for exec_id in self._on_going_tasks:
-            task_exec = self._on_going_tasks[exec_id]
+        extensions = []
+        # Read the clock once for the whole pass
+        now = time.time()
+        for task_exec in self._on_going_tasks.values():
             # Check if done
             if task_exec.results is not None:
                 # Process results
-                self._process_task_results(task_exec, bye_bye_tasks)
+                self._process_task_results(task_exec, bye_bye_tasks, now=now)
                 continue
-            if not task_exec.thread.is_alive():
-                # Thread finished without results, that's not good :(
-                self._process_dead_thread(task_exec, bye_bye_tasks)
+            if task_exec.finished:
+                # Execution finished without results, that's not good :(
+                self._process_dead_thread(task_exec, bye_bye_tasks, now=now)
                 continue
-            # Check if outdated
-            if datetime.utcnow() > task_exec.get_deadline() and not task_exec.postpone(self.queue_handler):
+            # Check if outdated, leaving the visibility change RPC to the extender thread
+            if now > task_exec.deadline_epoch:
+                extensions.append((task_exec, task_exec.extend(now)))
+        if extensions:
+            with self._extensions_cv:
+                self._extensions.extend(extensions)
+                self._extensions_cv.notify()
+        # Resend tasks whose visibility change failed, unless they are already gone
+        while self._failed_extensions:
+            task_exec = self._failed_extensions.popleft()
+            if self._on_going_tasks.get(task_exec.exec_id) is task_exec and task_exec.exec_id not in bye_bye_tasks:
                 self._postpone_failed(task_exec, bye_bye_tasks)
         # Bye bye
         for exec_id in bye_bye_tasks:
@@ -167,110 +443,120 @@ class TaskConsumer(object):
         # Disable
         task_exec.disabled = True
         # Delete original one
-        self.queue_handler.done(task_exec.message)
+        self.queue_handler.done_later(task_exec.message)
         bye_bye_tasks.append(task_exec.exec_id)
 
-    def _process_task_results(self, task_exec, bye_bye_tasks):
-        """Process results."""
+    def _process_task_results(self, task_exec, bye_bye_tasks, now=None):
+        """Process results, now being the current epoch time if already known."""
         # Results is either true or false
         if task_exec.results is True:
             # The task was a great success!
-            self.queue_handler.done(task_exec.message)
+            self.queue_handler.done_later(task_exec.message)
         elif task_exec.results is False:
             # Task failed, calc visibility delay
-            vis_delay = (datetime.utcnow() - task_exec.created_at).total_seconds() + \
-                        task_exec.task.get_delay(task_exec.attempts)
+            vis_delay = (now or time.time()) - task_exec.created_epoch + task_exec.task.get_delay(task_exec.attempts)
             # Postpone message
-            self.queue_handler.postpone(task_exec.message, int(vis_delay))
+            self.queue_handler.postpone_later(task_exec.message, vis_delay)
         # Delete ongoing task
         bye_bye_tasks.append(task_exec.exec_id)
 
-    def _process_dead_thread(self, task_exec, bye_bye_tasks):
-        """Process a dead thread to be considered a failed execution."""
+    def _process_dead_thread(self, task_exec, bye_bye_tasks, now=None):
+        """Process an execution that finished without results as a failed one, now being the current epoch time."""
         # A dead thread is considered fail
         _logger.error("DEAD_THREAD: {} {}".format(task_exec.task.name, task_exec.exec_id),
                       job_id=task_exec.job_id, job_name=task_exec.job_name)
         if task_exec.disabled:
             # Delete message
-            self.queue_handler.done(task_exec.message)
+            self.queue_handler.done_later(task_exec.message)
         else:
             # Postpone message
-            vis_delay = (datetime.utcnow() - task_exec.created_at).total_seconds() + \
-                        task_exec.task.get_delay(task_exec.attempts)
-            self.queue_handler.postpone(task_exec.message, vis_delay)
+            vis_delay = (now or time.time()) - task_exec.created_epoch + task_exec.task.get_delay(task_exec.attempts)
+            self.queue_handler.postpone_later(task_exec.message, vis_delay)
         # Delete ongoing task
         bye_bye_tasks.append(task_exec.exec_id)
 
-    def _is_known_task(self, message):
-        """Return whether task in message is int task map."""
-        return \
-            "task_name" in message.message_attributes and \
-            "StringValue" in message.message_attributes["task_name"] and \
-            message.message_attributes["task_name"]["StringValue"] in self.task_map
-
-    def _passed_when(self, message):
-        when = datetime.strptime(message.message_attributes["when"]["StringValue"], "%d/%m/%y %H:%M:%S")
-        if (datetime.utcnow() + timedelta(minutes=1)) > when:
+    def _passed_when(self, message, when=None):
+        """Return whether the message's when, minus the when window, has passed. Takes when if already parsed."""
+        if when is None:
+            when = _message_when(message)
+            if when is None:
+                return True
+        now = time.time()
+        if now + 60 > when:
             # log if execution is more than one minute late
-            job_id = message.message_attributes.get("job_id", {"StringValue": "unknown"})["StringValue"]
-            job_name = message.message_attributes.get("job_name", {"StringValue": "unknown"})["StringValue"]
+            job_id = message.message_attributes.get("job_id", _UNKNOWN)["StringValue"]
+            job_name = message.message_attributes.get("job_name", _UNKNOWN)["StringValue"]
             _logger.warn(
                 "EXEC_1MIN_PASSED_DUE_DATE: {} ({})>({})".format(
-                    message.message_attributes["exec_id"]["StringValue"], datetime.utcnow(), when
+                    message.message_attributes["exec_id"]["StringValue"], now, when
                 ),
                 job_id=job_id,
                 job_name=job_name
             )
-        when -= timedelta(seconds=self.when_window)
-        return datetime.utcnow() > when
-
-    def _when_to_seconds(self, message):
-        when = datetime.strptime(message.message_attributes["when"]["StringValue"], "%d/%m/%y %H:%M:%S") \
-               - timedelta(seconds=self.when_window)
-        total = (when - datetime.utcnow()).total_seconds()
+        return now > when - self.when_window
+
+    def _when_to_seconds(self, message, when=None):
+        """Return how many seconds until the message can run, at most 5 hours. Takes when if already parsed."""
+        if when is None:
+            when = _message_when(message)
+            if when is None:
+                return 0
+        total = when - self.when_window - time.time()
         return math.ceil(total) if total <= 18000 else 18000
 
     def _get_new_tasks(self, num):
         """
-        Get new tasks for execution.
+        Get new tasks for execution from the messages fetched by the receivers.
 
         TODO: Messages that are in the queue for too long should bet recreated before they expire.
         :param num: Max number of tasks to be received.
         """
-        # Retrieve num messages
-        messages = self.queue_handler.retrieve(num)
+        # Take up to num received messages
+        messages = []
+        while len(messages) < num:
+            try:
+                messages.append(self._received.get_nowait())
+            except queue.Empty:
+                break
         if len(messages) > 0:
-            _logger.info("RETRIEVED_TASKS: {}/{}".format(len(messages), num))
+            _logger.info("RETRIEVED_TASKS: %s/%s", len(messages), num)
         # Create a TaskExecution object for each message
         tasks = []
-        for message in messages:
-            _logger.debug("Received message:  header = {} body = {}".format(message.message_attributes, message.body))
-            job_id = message.message_attributes.get("job_id", {"StringValue": "unknown"})["StringValue"]
-            job_name = message.message_attributes.get("job_name", {"StringValue": "unknown"})["StringValue"]
+        for message, received_at in messages:
+            _logger.debug("Received message:  header = %s body = %s", message.message_attributes, message.body)
+            attributes = message.message_attributes or _EMPTY
+            job_id = attributes.get("job_id", _UNKNOWN)["StringValue"]
+            job_name = attributes.get("job_name", _UNKNOWN)["StringValue"]
             # Check if message has a known task
-            if not self._is_known_task(message):
+            task = self.task_map.get(attributes.get("task_name", _EMPTY).get("StringValue"))
+            if task is None:
                 _logger.warn(
                     "RECEIVED_UNKNOWN_TASK: header = {} attr = {}".format(message.message_attributes, message.body),
                     job_id=job_id,
                     job_name=job_name
                 )
-                if int(message.attributes['ApproximateReceiveCount']) > self.unknown_tasks_retries:
-                    self.queue_handler.done(message)
+                if getattr(self.queue_handler, "max_receive_count", None):
+                    # Leave it to reappear after its visibility timeout, the redrive policy the queue handler
+                    # made sure the queue has moves it to the dead letter queue after too many receives
+                    pass
+                elif int(message.attributes['ApproximateReceiveCount']) > self.unknown_tasks_retries:
+                    self.queue_handler.done_later(message)
                 else:
-                    self.queue_handler.postpone(message, self.unknown_tasks_delay)
+                    self.queue_handler.postpone_later(message, self.unknown_tasks_delay)
                 continue
             # Check if the task should be executed later
-            if not self._passed_when(message):
+            when = _message_when(message)
+            if when is not None and not self._passed_when(message, when):
                 # Postpone it as long as possible
-                self.queue_handler.postpone(message, self._when_to_seconds(message))
+                self.queue_handler.postpone_later(message, self._when_to_seconds(message, when))
                 continue
             tasks.append(
                 self._task_execution_class(
-                    exec_id=message.message_attributes["exec_id"]["StringValue"],
-                    task=self.task_map[message.message_attributes["task_name"]["StringValue"]],
+                    exec_id=attributes["exec_id"]["StringValue"],
+                    task=task,
                     attr=json.loads(message.body),
                     attempts=int(message.attributes['ApproximateReceiveCount']),
-                    created_at=datetime.utcnow(),
+                    created_at=received_at,
                     message=message,
                     timeout=self.queue_handler.task_timeout,
                     job_id=job_id,
@@ -281,13 +567,12 @@ class TaskConsumer(object):
         return tasks
 
     def _run_tasks(self, tasks):
-        """Run tasks."""
+        """Run tasks by handing them to the worker threads."""
         for task_exec in tasks:
-            _logger.info("RUNNING_TASK: {} {}".format(task_exec.task.name, task_exec.exec_id),
+            _logger.info("RUNNING_TASK: %s %s", task_exec.task.name, task_exec.exec_id,
                          job_id=task_exec.job_id, job_name=task_exec.job_name)
-            task_exec.thread = threading.Thread(target=task_exec.execute)
-            task_exec.thread.start()
             self._on_going_tasks[task_exec.exec_id] = task_exec
+            self._executor.submit(self._execute, task_exec)
 
     def get_status(self):
         if (
@@ -4,18 +4,24 @@
 Copyright (c) SambaTech. All rights reserved.
 
 created_at: 10-JUL-2018
-updated_at: 10-JUL-2018
+updated_at: 15-OCT-2026
 """
 import math
+import time
 from datetime import datetime, timedelta
 
 from samba_chassis import logging
 _logger = logging.getLogger(__name__)
 
+_EPOCH = datetime(1970, 1, 1)
+
 
 class TaskExecution(object):
     """Encapsulation of a task execution command."""
 
+    __slots__ = ("exec_id", "task", "attr", "attempts", "created_at", "message", "timeout", "results", "finished",
+                 "disabled", "postpone_num", "job_id", "job_name", "created_epoch", "deadline_epoch")
+
     def __init__(self, exec_id, task, attr, attempts, created_at, message, timeout, job_id, job_name):
         """
         Initiate object.
@@ -39,15 +45,27 @@ class TaskExecution(object):
         self.message = message
         self.timeout = timeout
         self.results = None
-        self.thread = None
+        self.finished = False
         self.disabled = False
         self.postpone_num = 0
         self.job_id = job_id
         self.job_name = job_name
+        # Creation and deadline as UTC epoch floats, so the consumer loop compares them with a single
+        # time.time() snapshot
+        self.created_epoch = (created_at - _EPOCH).total_seconds()
+        self.deadline_epoch = self.created_epoch + int(timeout / 2)
+
+    def execute(self, executor=None):
+        """
+        Run task.
 
-    def execute(self):
-        """Run task."""
-        res = self.task.run(self.attr, self.attempts - 1, job_id=self.job_id, job_name=self.job_name)
+        :param executor: Executor to run the task function on, such as a process pool. If None, runs it in place.
+        """
+        if executor is None:
+            res = self.task.run(self.attr, self.attempts - 1, job_id=self.job_id, job_name=self.job_name)
+        else:
+            res = self.task.run(self.attr, self.attempts - 1, job_id=self.job_id, job_name=self.job_name,
+                                executor=executor)
         if not self.disabled:
             self.results = res
 
@@ -55,10 +73,37 @@ class TaskExecution(object):
         """Return execution command deadline."""
         return self.created_at + timedelta(seconds=int(self.timeout / 2) * (self.postpone_num + 1))
 
-    def postpone(self, queue_handler):
-        """Postpone execution command deadline."""
-        new_timeout = int(math.ceil((self.get_deadline() - datetime.utcnow()).total_seconds())) + self.timeout
-        _logger.info("POSTPONE: {} for {} {}".format(new_timeout, self.task.name, self.exec_id),
+    def postpone(self, queue_handler, now=None):
+        """
+        Postpone execution command deadline, moving it half a timeout forward on success.
+
+        :param queue_handler: Queue handler holding the command message.
+        :param now: Current epoch time, taken from time.time() if not given.
+        """
+        if not queue_handler.postpone(self.message, self._postpone_timeout(now)):
+            return False
+        self.postpone_num += 1
+        self.deadline_epoch += int(self.timeout / 2)
+        return True
+
+    def extend(self, now=None):
+        """
+        Move execution command deadline half a timeout forward ahead of its message visibility change.
+
+        :param now: Current epoch time, taken from time.time() if not given.
+        :return: Visibility timeout the message needs to keep up with the new deadline.
+        """
+        new_timeout = self._postpone_timeout(now)
+        self.postpone_num += 1
+        self.deadline_epoch += int(self.timeout / 2)
+        return new_timeout
+
+    def _postpone_timeout(self, now=None):
+        """Return the visibility timeout for postponing the command message now."""
+        if now is None:
+            now = time.time()
+        new_timeout = int(math.ceil(self.deadline_epoch - now)) + self.timeout
+        _logger.info("POSTPONE: %s for %s %s", new_timeout, self.task.name, self.exec_id,
                      job_id=self.job_id, job_name=self.job_name)
-        return queue_handler.postpone(self.message, new_timeout)
+        return new_timeout
 
@@ -4,56 +4,150 @@
 Copyright (c) SambaTech. All rights reserved.
 
 created_at: 10-JUL-2018
-updated_at: 10-JUL-2018
+updated_at: 15-OCT-2026
 """
 import boto3
-import warnings
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import json
 import uuid
-from datetime import datetime
+import time
+import calendar
 
 from samba_chassis import logging
 _logger = logging.getLogger(__name__)
 
+# SQS client and resource shared by every queue handler
+_sqs_client = None
+_sqs = None
+_sqs_lock = threading.Lock()
+# HTTP connections kept per client, enough for worker threads sending tasks concurrently
+_max_pool_connections = 50
+# Retries per call after the first attempt, so throttled and transient failures get 3 attempts in total
+_max_retries = 2
+# Threads sending deletion batches concurrently
+_io_pool = None
+_io_pool_size = 4
+# Attributes requested on every receive, built once instead of per poll
+_receive_attributes = ['ApproximateReceiveCount', 'SentTimestamp']
+_receive_message_attributes = ['All']
+# SQS limit on a send batch's payload, message bodies plus attributes
+_max_batch_bytes = 262144
+# Format of the when attribute, read by every consumer version
+_WHEN_FORMAT = "%d/%m/%y %H:%M:%S"
+# Last when string formatted, as (epoch seconds, string), reused by sends within the same second
+_last_when = (None, None)
+
+
+def _get_sqs():
+    """Return the shared SQS client and resource, creating them on first use."""
+    global _sqs_client, _sqs
+    if _sqs is None:
+        with _sqs_lock:
+            if _sqs is None:
+                config = Config(max_pool_connections=_max_pool_connections, retries={"max_attempts": _max_retries})
+                _sqs_client = boto3.client('sqs', config=config)
+                _sqs = boto3.resource('sqs', config=config)
+    return _sqs_client, _sqs
+
+
+def _get_io_pool():
+    """Return the thread pool shared by queue handlers to overlap SQS calls, creating it on first use."""
+    global _io_pool
+    if _io_pool is None:
+        with _sqs_lock:
+            if _io_pool is None:
+                _io_pool = ThreadPoolExecutor(max_workers=_io_pool_size)
+    return _io_pool
+
+
+def _message_size(message):
+    """Return the bytes a message's body and attributes count toward the SQS payload limit."""
+    size = len(message["MessageBody"].encode("utf-8"))
+    for name, value in message["MessageAttributes"].items():
+        size += len(name) + len(value["DataType"]) + len(value["StringValue"].encode("utf-8"))
+    return size
+
+
+def _when_string(epoch):
+    """Return the when attribute string for UTC epoch seconds, formatting each second only once."""
+    global _last_when
+    last = _last_when
+    if last[0] != epoch:
+        last = _last_when = (epoch, time.strftime(_WHEN_FORMAT, time.gmtime(epoch)))
+    return last[1]
+
 
 class QueueHandler(object):
     """Queue handler responsible to communicate with SQS, send and retrieve tasks."""
 
-    _sqs_client = None
-    _sqs = None
-
-    def __init__(self, queue_name, task_timeout=120):
+    def __init__(self, queue_name, task_timeout=120, max_receive_count=None):
         """
         Take queue name and create SQS connection.
 
         :param queue_name: SQS queue name.
         :param task_timeout: Seconds for message processing deadline.
+        :param max_receive_count: Receives before SQS moves a message to the queue's dead letter queue.
+        If None, the queue is created without a dead letter queue. An existing queue without a redrive policy
+        gets one on connect; if that fails max_receive_count is reset to None.
         """
-        _logger.debug("CREATING_QUEUE_HANDLER {}".format(queue_name))
+        _logger.debug("CREATING_QUEUE_HANDLER %s", queue_name)
         self.queue_name = queue_name
         self.queue = None
         self.task_timeout = task_timeout
+        self.max_receive_count = max_receive_count
+        self._pending_deletes = []
+        self._pending_lock = threading.Lock()
+        self._deletes_in_flight = []
+        self._pending_postpones = []
 
     def connect(self):
-        # Setup sqs if yet not set
-        if self._sqs_client is None:
-            self._sqs_client = boto3.client('sqs')
-        if self._sqs is None:
-            self._sqs = boto3.resource('sqs')
         # Setup queue if yet not set
         if self.queue is None:
+            sqs_client, sqs = _get_sqs()
             # Create queue if necessary
             try:
-                self.queue = self._sqs.get_queue_by_name(QueueName=self.queue_name)
-            except self._sqs_client.exceptions.QueueDoesNotExist:
-                _logger.info("CREATING_QUEUE_IN_AWS: {}".format(self.queue_name))
-                self.queue = self._sqs.create_queue(
-                    QueueName=self.queue_name,
-                    Attributes={
-                        "ReceiveMessageWaitTimeSeconds": "2",
-                        "VisibilityTimeout": "120"
-                    }
-                )
+                self.queue = sqs.get_queue_by_name(QueueName=self.queue_name)
+            except sqs_client.exceptions.QueueDoesNotExist:
+                _logger.info("CREATING_QUEUE_IN_AWS: %s", self.queue_name)
+                attributes = {
+                    "ReceiveMessageWaitTimeSeconds": "20",
+                    "VisibilityTimeout": "120"
+                }
+                if self.max_receive_count:
+                    attributes["RedrivePolicy"] = self._redrive_policy(sqs_client, sqs)
+                self.queue = sqs.create_queue(QueueName=self.queue_name, Attributes=attributes)
+            else:
+                if self.max_receive_count and "RedrivePolicy" not in self.queue.attributes:
+                    self._set_redrive_policy(sqs_client, sqs)
+
+    def _set_redrive_policy(self, sqs_client, sqs):
+        """Add a redrive policy to an existing queue, giving up max_receive_count if it can't be set."""
+        _logger.info("SETTING_QUEUE_REDRIVE_POLICY: %s", self.queue_name)
+        try:
+            self.queue.set_attributes(Attributes={"RedrivePolicy": self._redrive_policy(sqs_client, sqs)})
+        except (ClientError, BotoCoreError) as e:
+            _logger.warning("REDRIVE_POLICY_NOT_SET: {} {}".format(self.queue_name, e))
+            self.max_receive_count = None
+
+    def _redrive_policy(self, sqs_client, sqs):
+        """Return the queue's RedrivePolicy attribute value."""
+        return json.dumps({
+            "deadLetterTargetArn": self._dead_letter_queue_arn(sqs_client, sqs),
+            "maxReceiveCount": str(self.max_receive_count)
+        })
+
+    def _dead_letter_queue_arn(self, sqs_client, sqs):
+        """Return the ARN of the queue's dead letter queue, creating it if necessary."""
+        dlq_name = "{}_dlq".format(self.queue_name)
+        try:
+            dlq = sqs.get_queue_by_name(QueueName=dlq_name)
+        except sqs_client.exceptions.QueueDoesNotExist:
+            _logger.info("CREATING_QUEUE_IN_AWS: %s", dlq_name)
+            dlq = sqs.create_queue(QueueName=dlq_name, Attributes={"MessageRetentionPeriod": "1209600"})
+        return dlq.attributes["QueueArn"]
 
     def send(self, task_name, task_attr, delay=0, exec_id=None, when=None, **kwargs):
         """
@@ -63,60 +157,103 @@ class QueueHandler(object):
         :param task_attr: Task attributes in dict form.
         :param delay: Time in seconds for the task to become available for execution.
         :param exec_id: Task execution command id.
-        :param when: Datetime that tells when can the task execute.
+        :param when: Datetime that tells when can the task execute. It is sent both in the "%d/%m/%y %H:%M:%S"
+        format older consumers parse and as UTC epoch seconds in when_epoch.
         """
         self.connect()
-        _logger.debug(
-            "Sending task {}".format(task_name),
-            job_id=kwargs.get("job_id", "unknown"),
-            job_name=kwargs.get("job_name", "unknown")
-        )
+        self.queue.send_message(**self._message(task_name, task_attr, delay, exec_id, when, **kwargs))
 
-        self.queue.send_message(
-            MessageBody=json.dumps(task_attr),
-            DelaySeconds=delay,
-            MessageAttributes={
-                "task_name": {'StringValue': task_name, 'DataType': 'String'},
-                "exec_id": {'StringValue': str(uuid.uuid4()) if exec_id is None else exec_id, 'DataType': 'String'},
-                "when": {
-                    'StringValue': datetime.utcnow().strftime("%d/%m/%y %H:%M:%S")
-                    if when is None else when.strftime("%d/%m/%y %H:%M:%S"),
-                    'DataType': 'String'
-                },
-                "job_id": {'StringValue': kwargs.get("job_id", "unknown"), 'DataType': 'String'},
-                "job_name": {'StringValue': kwargs.get("job_name", "unknown"), 'DataType': 'String'},
-            }
-        )
+    def send_many(self, tasks, **kwargs):
+        """
+        Send several tasks to SQS queue, in batches of up to 10 messages and 256KB.
+
+        :param tasks: Iterable of (task_name, task_attr) tuples, optionally followed by delay, exec_id and when
+        as taken by send.
+        :return: List of the tasks that could not be sent.
+        """
+        self.connect()
+        failed = []
+        batch, entries, size = [], [], 0
+        for task in tasks:
+            entry = self._message(*task, **kwargs)
+            entry_size = _message_size(entry)
+            if entries and (len(entries) == 10 or size + entry_size > _max_batch_bytes):
+                self._send_batch(batch, entries, failed)
+                batch, entries, size = [], [], 0
+            entry["Id"] = str(len(entries))
+            batch.append(task)
+            entries.append(entry)
+            size += entry_size
+        if entries:
+            self._send_batch(batch, entries, failed)
+        return failed
+
+    def _send_batch(self, batch, entries, failed):
+        """Send the message entries of a batch of tasks, adding the tasks not sent to failed."""
+        try:
+            response = self.queue.send_messages(Entries=entries)
+        except Exception:
+            _logger.exception("SEND_FAILURE: {} messages".format(len(batch)))
+            failed.extend(batch)
+            return
+        for failure in response.get("Failed", []):
+            _logger.error("SEND_FAILURE: {}".format(failure))
+            failed.append(batch[int(failure["Id"])])
+
+    @staticmethod
+    def _message(task_name, task_attr, delay=0, exec_id=None, when=None, **kwargs):
+        """Return the SQS send arguments for a task, as described in send."""
+        job_id = kwargs.get("job_id", "unknown")
+        job_name = kwargs.get("job_name", "unknown")
+        _logger.debug("Sending task %s", task_name, job_id=job_id, job_name=job_name)
+
+        epoch = int(time.time()) if when is None else calendar.timegm(when.utctimetuple())
+        attributes = {
+            "task_name": {'StringValue': task_name, 'DataType': 'String'},
+            "exec_id": {'StringValue': uuid.uuid4().hex if exec_id is None else exec_id, 'DataType': 'String'},
+            "when": {'StringValue': _when_string(epoch), 'DataType': 'String'},
+            "when_epoch": {'StringValue': str(epoch), 'DataType': 'Number'}
+        }
+        # Consumers read missing job attributes as unknown
+        if job_id != "unknown":
+            attributes["job_id"] = {'StringValue': job_id, 'DataType': 'String'}
+        if job_name != "unknown":
+            attributes["job_name"] = {'StringValue': job_name, 'DataType': 'String'}
+        return {"MessageBody": json.dumps(task_attr), "DelaySeconds": delay, "MessageAttributes": attributes}
 
     def queue_len(self):
+        """Return the approximate number of visible messages, fetching only that attribute."""
         self.connect()
-        self.queue.load()
-        return int(self.queue.attributes["ApproximateNumberOfMessages"])
+        sqs_client, _ = _get_sqs()
+        response = sqs_client.get_queue_attributes(
+            QueueUrl=self.queue.url, AttributeNames=["ApproximateNumberOfMessages"]
+        )
+        return int(response["Attributes"]["ApproximateNumberOfMessages"])
 
     def retrieve(self, max_number=1):
         """
         Retrieve at most max_number messages.
 
+        SQS returns at most 10 messages per call, more are retrieved in extra calls
+        only while the previous ones come back full.
         :param max_number: Maximum number of messages to be returned.
         :return: Retrieved messages.
         """
         self.connect()
-        _logger.debug("Retrieving {} messages".format(max_number))
-        # Check max number limit
-        if max_number > 10:
-            max_number = 10
-            warnings.warn("Tried to retrieve more than 10 messages")
-
-        messages = self.queue.receive_messages(
-            AttributeNames=[
-                'ApproximateReceiveCount',
-                'SentTimestamp'
-            ],
-            MessageAttributeNames=['All'],
-            MaxNumberOfMessages=max_number,
-            VisibilityTimeout=self.task_timeout,
-            WaitTimeSeconds=1
-        )
+        _logger.debug("Retrieving %s messages", max_number)
+        messages = []
+        while max_number > 0:
+            batch = self.queue.receive_messages(
+                AttributeNames=_receive_attributes,
+                MessageAttributeNames=_receive_message_attributes,
+                MaxNumberOfMessages=min(max_number, 10),
+                VisibilityTimeout=self.task_timeout,
+                WaitTimeSeconds=20
+            )
+            messages.extend(batch)
+            if len(batch) < 10:
+                break
+            max_number -= len(batch)
         return messages
 
     @staticmethod
@@ -128,6 +265,100 @@ class QueueHandler(object):
         """
         message.delete()
 
+    def done_later(self, message):
+        """
+        Schedule message deletion from queue service.
+
+        Every 10 messages a deletion batch is sent in the background, call flush_deletes to send the remaining ones.
+        :param message: Message to be deleted.
+        """
+        self.done_many_later((message,))
+
+    def done_many_later(self, messages):
+        """
+        Schedule deletion of several messages from queue service, as done_later does for one.
+
+        :param messages: Messages to be deleted.
+        """
+        with self._pending_lock:
+            self._pending_deletes.extend(messages)
+            full = len(self._pending_deletes) // 10 * 10
+            if full == 0:
+                return
+            batches, self._pending_deletes = self._pending_deletes[:full], self._pending_deletes[full:]
+            self.connect()
+            io_pool = _get_io_pool()
+            self._deletes_in_flight.extend(
+                io_pool.submit(self._delete_batch, batches[i:i + 10]) for i in range(0, full, 10)
+            )
+
+    def flush_deletes(self):
+        """Delete all messages scheduled for deletion, sending batches of 10 concurrently, and wait for them."""
+        with self._pending_lock:
+            pending, self._pending_deletes = self._pending_deletes, []
+            in_flight, self._deletes_in_flight = self._deletes_in_flight, []
+        if pending:
+            self.connect()
+            batches = [pending[i:i + 10] for i in range(0, len(pending), 10)]
+            # Send the first batch from this thread while the others go through the pool
+            in_flight.extend(_get_io_pool().submit(self._delete_batch, batch) for batch in batches[1:])
+            self._delete_batch(batches[0])
+        wait(in_flight)
+
+    def _delete_batch(self, batch):
+        """Delete up to 10 messages in a single call."""
+        try:
+            response = self.queue.delete_messages(
+                Entries=[{"Id": str(j), "ReceiptHandle": m.receipt_handle} for j, m in enumerate(batch)]
+            )
+        except Exception:
+            _logger.exception("DELETE_FAILURE: {} messages".format(len(batch)))
+            return
+        for failure in response.get("Failed", []):
+            _logger.error("DELETE_FAILURE: {}".format(failure))
+
+    def postpone_later(self, message, new_timeout):
+        """
+        Schedule a message visibility change, sent in batches of 10 by flush_postpones.
+
+        Use postpone instead when the caller needs to know whether the change succeeded.
+        :param message: Message to postpone.
+        :param new_timeout: New deadline to set.
+        """
+        with self._pending_lock:
+            self._pending_postpones.append((message, int(new_timeout)))
+
+    def flush_postpones(self):
+        """Send all scheduled visibility changes, in batches of 10."""
+        with self._pending_lock:
+            pending, self._pending_postpones = self._pending_postpones, []
+        if not pending:
+            return
+        for i in range(0, len(pending), 10):
+            self.postpone_batch(pending[i:i + 10])
+
+    def postpone_batch(self, postpones):
+        """
+        Change the visibility of up to 10 messages in a single call.
+
+        :param postpones: List of (message, new timeout) tuples.
+        :return: Set of the positions in postpones whose change failed.
+        """
+        self.connect()
+        try:
+            response = self.queue.change_message_visibility_batch(Entries=[
+                {"Id": str(i), "ReceiptHandle": m.receipt_handle, "VisibilityTimeout": int(timeout)}
+                for i, (m, timeout) in enumerate(postpones)
+            ])
+        except Exception:
+            _logger.exception("VISIBILITY_CHANGE_FAILURE: {} messages".format(len(postpones)))
+            return set(range(len(postpones)))
+        failed = set()
+        for failure in response.get("Failed", []):
+            _logger.error("VISIBILITY_CHANGE_FAILURE: {}".format(failure))
+            failed.add(int(failure["Id"]))
+        return failed
+
     @staticmethod
     def postpone(message, new_timeout):
         """
@@ -139,8 +370,11 @@ class QueueHandler(object):
         try:
             message.change_visibility(VisibilityTimeout=int(new_timeout))
             return True
-        except:
-            job_id = message.message_attributes.get("job_id", {"StringValue": "unknown"})["StringValue"]
-            job_name = message.message_attributes.get("job_name", {"StringValue": "unknown"})["StringValue"]
-            _logger.exception("VISIBILITY_CHANGE_FAILURE", job_id=job_id, job_name=job_name)
+        except (ClientError, BotoCoreError) as e:
+            attributes = message.message_attributes or {}
+            job_id = attributes.get("job_id", {"StringValue": "unknown"})["StringValue"]
+            job_name = attributes.get("job_name", {"StringValue": "unknown"})["StringValue"]
+            # The error code is enough to tell throttling or an expired receipt apart, skip the traceback
+            code = e.response.get("Error", {}).get("Code") if isinstance(e, ClientError) else type(e).__name__
+            _logger.error("VISIBILITY_CHANGE_FAILURE: {}".format(code), job_id=job_id, job_name=job_name)
             return False
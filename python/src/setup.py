@@ -20,8 +20,10 @@ setup(
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Topic :: Utilities",
-        "Programming Language :: Python :: 2.7"
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.6"
     ],
     install_requires=["setuptools", "pyyaml", "sqlalchemy", "boto3", "requests"],
-    python_requires=">=2.7"
+    extras_require={"speedups": ["orjson"]},
+    python_requires=">=3.6"
 )
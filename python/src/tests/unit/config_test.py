@@ -9,6 +9,8 @@ updated_at: 06-JUL-2018
 """
 import pytest
 import os
+import shutil
+import tempfile
 import samba_chassis
 from samba_chassis import config
 from mock import MagicMock
@@ -30,6 +32,9 @@ class JobTrackerTests(unittest.TestCase):
         c.current = 10
         assert c.eval() is False
 
+        c.current = c.default
+        assert c.eval() is True
+
     def test_config_layout(self):
         config._config_ledger["default"] = MagicMock(config_a="allepo", config_b="bill")
 
@@ -50,6 +55,28 @@ class JobTrackerTests(unittest.TestCase):
         })
         assert c.simple_dict == {".config_a": config_a, ".config_b": config_b}
 
+        c2 = config.ConfigLayout(c.config_dict)
+        assert c2.simple_dict == c.simple_dict
+        assert c2.simple_dict is not c.simple_dict
+
+    def test_simplify_cached(self):
+        layouts = [{"config_a": i} for i in range(config._simplify_cache_size + 1)]
+        for layout in layouts:
+            assert config._simplify_cached(layout) == {".config_a": layout["config_a"]}
+        # Only the most recent layouts are kept
+        assert len(config._simplify_cache) == config._simplify_cache_size
+        assert id(layouts[0]) not in config._simplify_cache
+        assert id(layouts[-1]) in config._simplify_cache
+
+    def test_config_layout_missing_base(self):
+        config._config_ledger["default"] = config._objectify("Test", {"other": {"config_a": "allepo"}})
+        config_a = config.ConfigItem(default="alejandro", type=str)
+        c = config.ConfigLayout({"config_a": config_a})
+        # A missing base falls back to the defaults
+        with pytest.warns(UserWarning):
+            ob = c.get(base="tasks")
+        assert ob.config_a == "alejandro"
+
     def test_require_env_var(self):
         os.environ = {"VARC1": 1, "VARC2": 2, "SYSTEM1": 1}
         assert config.require_env_var("SYSTEM1", rules=[lambda x: True if isinstance(x, int) else False]) == 1
@@ -90,11 +117,54 @@ class JobTrackerTests(unittest.TestCase):
 
         ob = config._objectify("Test", dictionary)
         assert config._retrieve(ob, ["t2", "", "t4", "2", "0"]) == 6
+        assert config._retrieve(ob, config._parse_path("t2..t4.2.0")) == 6
+
+    def test_parse_path(self):
+        assert config._parse_path(".t2.t4.2.0") == ("t2", "t4", 2, 0)
+        assert config._parse_path("t2.\u00b2") == ("t2", "\u00b2")
 
     def test_dict_from_env(self):
         os.environ = {"VARC1": 1, "VARC2": 2, "SYSTEM1": 1}
         d = samba_chassis.dict_from_env("VAR")
         assert d == {'C1': 1, 'C2': 2}
+        assert samba_chassis.dict_from_env() == {"VARC1": 1, "VARC2": 2, "SYSTEM1": 1}
+
+    def test_dict_from_yaml(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, "config.yml")
+            with open(filename, "w") as config_file:
+                config_file.write("t1: 1\nt2:\n  t3: three\n")
+            assert samba_chassis.dict_from_yaml(filename) == {"t1": 1, "t2": {"t3": "three"}}
+            assert sorted(os.listdir(tmp_dir)) == ["config.yml", "config.yml.json"]
+            assert samba_chassis.dict_from_json(filename + ".json")["content"] == {"t1": 1, "t2": {"t3": "three"}}
+            assert samba_chassis.dict_from_yaml(filename) == {"t1": 1, "t2": {"t3": "three"}}
+            # A cache of other content is not used, whatever the modification times
+            mtime = os.path.getmtime(filename + ".json")
+            with open(filename, "w") as config_file:
+                config_file.write("t1: 2\n")
+            os.utime(filename, (mtime - 10, mtime - 10))
+            assert samba_chassis.dict_from_yaml(filename) == {"t1": 2}
+            # Nor one that doesn't load
+            with open(filename + ".json", "w") as cache_file:
+                cache_file.write('{"t1": ')
+            assert samba_chassis.dict_from_yaml(filename) == {"t1": 2}
+            # Nor one in the former format
+            with open(filename + ".json", "w") as cache_file:
+                cache_file.write('{"t1": 1}')
+            assert samba_chassis.dict_from_yaml(filename) == {"t1": 2}
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_dict_from_json(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, "config.json")
+            with open(filename, "w") as config_file:
+                config_file.write('{"t1": 1, "t2": {"t3": "three"}}')
+            assert samba_chassis.dict_from_json(filename) == {"t1": 1, "t2": {"t3": "three"}}
+        finally:
+            shutil.rmtree(tmp_dir)
 
     def test_objectify(self):
         dictionary = {
@@ -110,6 +180,7 @@ class JobTrackerTests(unittest.TestCase):
         assert ob.t2.t3 == 3
         assert ob.t2.t4[0] == 4
         assert ob.t2.t4[2][0] == 6
+        assert type(config._objectify("Test", dictionary)) is type(ob)
 
     def test_simplify(self):
         dictionary = {
@@ -122,6 +193,8 @@ class JobTrackerTests(unittest.TestCase):
         assert config._simplify(dictionary) == \
                {'.t1': 1, '.t2.t4.0': 4, '.t2.t4.1': 5,
                 '.t2.t4.2.0': 6, '.t2.t4.2.1': 7, '.t2.t3': 3}
+        assert list(config._simplify(dictionary)) == \
+               ['.t1', '.t2.t3', '.t2.t4.0', '.t2.t4.1', '.t2.t4.2.0', '.t2.t4.2.1']
 
     def test_alias(self):
         dictionary = {
@@ -136,6 +209,8 @@ class JobTrackerTests(unittest.TestCase):
         assert ob.t2.t4[2][0] == ".t1"
         ob = config._objectify("Object", dictionary, config._simplify(dictionary))
         assert ob.t2.t4[2][0] == 1
+        assert config._objectify("Object", {"t1": ""}).t1 == ""
 
     def test_cap_first(self):
         assert samba_chassis.cap_first("snAke_case") == "SnAkeCase"
+        assert samba_chassis.cap_first("object") == "Object"
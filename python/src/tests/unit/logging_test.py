@@ -10,6 +10,8 @@ updated_at: 09-JUL-2018
 from samba_chassis import logging
 from samba_chassis.logging import stackdriver
 from mock import MagicMock, patch
+import json
+import logging as stdlib_logging
 import unittest
 
 
@@ -21,19 +23,51 @@ class LoggingTest(unittest.TestCase):
         logger.setLevel("DEBUG")
         logger.debug("test log record")
 
-    @patch("math.modf")
-    def test_format_stackdriver_json(self, modf):
-        record = MagicMock(
-            thread=1,
-            levelname="lname",
-            pathname="pname",
-            lineno=1,
-            exc_text="exc_text"
-        )
-        record.name = "module name"
-        modf.return_value = 1, 1
-
-        self.assertEqual(
-            '{"message": "test message", "timestamp": {"seconds": 1, "nanos": 1000000000}, "thread": 1, "severity": "lname", "module": "module name", "file": "pname", "line": 1, "_mock_parent": null, "_mock_name": null, "_mock_new_name": "", "_mock_new_parent": null, "_spec_class": null, "_spec_set": null, "_spec_signature": null, "_mock_methods": null, "_mock_wraps": null, "_mock_delegate": null, "_mock_called": false, "_mock_call_args": null, "_mock_call_count": 0, "_mock_call_args_list": [], "_mock_mock_calls": [], "method_calls": [], "_mock_unsafe": false, "_mock_side_effect": null, "exception": ["exc_text"]}',
-            stackdriver._format_stackdriver_json(record, "test message")
-        )
+    def test_get_logger(self):
+        logger = logging.getLogger("test_get_logger")
+        self.assertIsInstance(logger, logging.ServiceLogger)
+        with patch.object(logging.logging, "setLoggerClass") as s:
+            self.assertIs(logging.getLogger("test_get_logger"), logger)
+            s.assert_not_called()
+
+    def test_job_extra(self):
+        logger = logging.getLogger("test_job_extra")
+        handler = MagicMock(level=0)
+        logger.addHandler(handler)
+        logger.setLevel("DEBUG")
+        logger.info("first", job_id="42", job_name="job")
+        logger.info("second")
+        extra = {"job_id": "7"}
+        logger.info("third", extra=extra)
+        records = [c[0][0] for c in handler.handle.call_args_list]
+        self.assertEqual((records[0].job_id, records[0].job_name), ("42", "job"))
+        self.assertEqual((records[1].job_id, records[1].job_name), ("unknown", "unknown"))
+        self.assertEqual((records[2].job_id, records[2].job_name), ("7", "unknown"))
+        self.assertEqual(extra, {"job_id": "7"})
+
+    def test_format_stackdriver_json(self):
+        record = stdlib_logging.LogRecord("module name", stdlib_logging.INFO, "pname", 1, "msg", None, None)
+        record.created = 1.5
+        record.exc_text = "exc_text"
+        record.job_id = "42"
+        record.unserializable = object()
+
+        payload = json.loads(stackdriver._format_stackdriver_json(record, "test \"message\"\nsecond line"))
+        self.assertEqual(payload["message"], "test 'message'; second line")
+        self.assertEqual(payload["timestamp"], {"seconds": 1, "nanos": 500000000})
+        self.assertEqual(payload["thread"], record.thread)
+        self.assertEqual(payload["severity"], "INFO")
+        self.assertEqual(payload["module"], "module name")
+        self.assertEqual(payload["file"], "pname")
+        self.assertEqual(payload["line"], 1)
+        self.assertEqual(payload["job_id"], "42")
+        self.assertEqual(payload["exception"], ["exc_text"])
+        self.assertNotIn("msg", payload)
+        self.assertEqual(payload["unserializable"], repr(record.unserializable))
+
+    def test_dumps(self):
+        payload = {"message": "test", "line": 1, "extra": [1, "two"]}
+        self.assertEqual(payload, json.loads(stackdriver._dumps(payload)))
+        with patch.object(stackdriver, "orjson", None):
+            self.assertEqual(json.dumps(payload, separators=(",", ":")), stackdriver._dumps(payload))
+            self.assertEqual(json.loads(stackdriver._dumps({"value": {1, 2}})), {"value": "{1, 2}"})
@@ -7,29 +7,59 @@ created_at: 11-JUN-2018
 updated_at: 11-JUL-2018
 """
 from samba_chassis import tasks
-from samba_chassis.tasks import *
-from mock import MagicMock, patch, ANY
+from samba_chassis.tasks import TaskConsumer, TaskExecution
+from mock import Mock, patch, ANY
 import unittest
-import boto3
-from datetime import datetime, timedelta
-import warnings
+from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from types import SimpleNamespace
+
+
+# Fixed clock for the when tests, so when strings and the consumer agree on the current second
+_NOW = 1531225800.5
+
+
+def _when(seconds):
+    """Return the former when string format for seconds after the fixed clock."""
+    return datetime.utcfromtimestamp(_NOW + seconds).strftime(tasks.consumers._WHEN_FORMAT)
+
+
+def _task_map():
+    """Return a task map for consumers whose tests never call the task, a plain object is enough."""
+    return {"test_task": SimpleNamespace(name="test_task")}
 
 
 class TaskConsumerTest(unittest.TestCase):
 
     @patch("threading.Thread")
     def test_start(self, T):
-        qh = MagicMock()
-        ts = TaskConsumer(qh, {"test_task": MagicMock()}, max_workers=2)
+        qh = Mock()
+        ts = TaskConsumer(qh, _task_map(), max_workers=2)
         self.assertEqual(ts.status, TaskConsumer.statuses.STOPPED)
         ts.start()
         self.assertEqual(ts.status, TaskConsumer.statuses.RUNNING)
+        T.assert_any_call(target=ts._scaling_loop)
         T.assert_called_with(target=ts.loop)
-        T().start.assert_called_once()
+        self.assertIsInstance(ts._executor, ThreadPoolExecutor)
+        self.assertIsNone(ts._process_pool)
+        ts._stop_workers()
+
+    @patch("threading.Thread")
+    def test_start_process_pool(self, T):
+        qh = Mock()
+        ts = TaskConsumer(qh, _task_map(), max_workers=2, pool_type="process")
+        ts.start()
+        self.assertIsInstance(ts._process_pool, ProcessPoolExecutor)
+        ts._stop_workers()
+        self.assertIsNone(ts._executor)
+        self.assertIsNone(ts._process_pool)
+        with self.assertRaises(ValueError):
+            TaskConsumer(qh, _task_map(), pool_type="fiber")
 
     def test_stop(self):
-        qh = MagicMock()
-        ts = TaskConsumer(qh, {"test_task": MagicMock()}, max_workers=2)
+        qh = Mock()
+        ts = TaskConsumer(qh, _task_map(), max_workers=2)
         ts.status = TaskConsumer.statuses.RUNNING
         ts.stop()
         self.assertEqual(ts.status, TaskConsumer.statuses.STOPPING)
@@ -37,74 +67,179 @@ class TaskConsumerTest(unittest.TestCase):
         ts.stop(force=True)
         self.assertEqual(ts.status, TaskConsumer.statuses.STOPPED)
 
-    @patch.object(tasks.consumers, "_logger")
+        # Stopping a stopped consumer leaves it stopped
+        ts.stop()
+        self.assertEqual(ts.status, TaskConsumer.statuses.STOPPED)
+
     @patch("threading.Thread")
-    def test_run_tasks(self, T, l):
-        qh = MagicMock()
-        te = MagicMock()
+    def test_start_stopping(self, T):
+        qh = Mock()
+        ts = TaskConsumer(qh, _task_map())
+        ts.status = TaskConsumer.statuses.STOPPING
+        ts.start()
+        self.assertEqual(ts.status, TaskConsumer.statuses.RUNNING)
+        T.assert_not_called()
+
+    @patch.object(tasks.consumers, "_logger")
+    def test_run_tasks(self, l):
+        qh = Mock()
+        te = Mock()
         te.task.name = "test"
         te.exec_id = "id"
         te.job_id = "id"
         te.job_name = "name"
         te.attr = {1: "one"}
 
-        ts = TaskConsumer(qh, {"test_task": MagicMock()}, max_workers=2)
+        ts = TaskConsumer(qh, _task_map(), max_workers=2)
+        ts._executor = Mock()
         ts._run_tasks([te])
 
-        l.info.assert_called_with('RUNNING_TASK: test id', job_id='id', job_name='name')
-        T.assert_called_with(target=te.execute)
+        l.info.assert_called_with('RUNNING_TASK: %s %s', 'test', 'id', job_id='id', job_name='name')
+        ts._executor.submit.assert_called_once_with(ts._execute, te)
         self.assertEqual(ts._on_going_tasks["id"], te)
 
+    def test_execute(self):
+        qh = Mock()
+        ts = TaskConsumer(qh, _task_map())
+        te1 = Mock(finished=False)
+        te2 = Mock(finished=False)
+        te2.execute.side_effect = Exception()
+        with patch.object(tasks.consumers, "_logger") as l:
+            ts._execute(te1)
+            ts._execute(te2)
+            self.assertEqual(l.exception.call_count, 1)
+        te1.execute.assert_called_once_with(None)
+        self.assertTrue(te1.finished)
+        self.assertTrue(te2.finished)
+        self.assertTrue(ts._wakeup.is_set())
+
+    def test_next_wakeup_seconds(self):
+        qh = Mock()
+        ts = TaskConsumer(qh, _task_map())
+        self.assertEqual(ts._next_wakeup_seconds(), 1.0)
+        te = Mock()
+        te.deadline_epoch = time.time() + 0.5
+        ts._on_going_tasks = {"test": te}
+        self.assertLessEqual(ts._next_wakeup_seconds(), 0.5)
+        self.assertGreater(ts._next_wakeup_seconds(), 0.3)
+        te.deadline_epoch = time.time() - 10
+        self.assertEqual(ts._next_wakeup_seconds(), 0.05)
+
     @patch.object(tasks.consumers, "_logger")
     @patch("datetime.datetime")
     def test_get_new_tasks(self, d, l):
         d.utcnow.return_value = "now"
-        qh = MagicMock(task_timeout=60)
-        ts = TaskConsumer(qh, {"test_task": MagicMock()}, max_workers=2)
-        m1 = MagicMock(
+        qh = Mock(task_timeout=60)
+        ts = TaskConsumer(qh, _task_map(), max_workers=2)
+        m1 = Mock(
             message_attributes={
                 "task_name": {"StringValue": "test_task"},
                 "exec_id": {"StringValue": "id"},
-                "when": {"StringValue": datetime.utcnow().strftime("%d/%m/%y %H:%M:%S")}
+                "when": {"StringValue": _when(0)}
             },
             body='{"1": "one"}',
             attributes={'ApproximateReceiveCount': 2}
         )
-        m2 = MagicMock(message_attributes={"wrong": "attrs"}, body="wrong_body")
-        qh.retrieve.return_value = [m1, m2]
+        m2 = Mock(message_attributes={"wrong": "attrs"}, body="wrong_body")
+        for m in (m1, m2):
+            ts._received.put((m, datetime.utcnow()))
 
         res = ts._get_new_tasks(5)
         l.warn.assert_called_with("RECEIVED_UNKNOWN_TASK: header = {'wrong': 'attrs'} attr = wrong_body", job_id='unknown', job_name='unknown')
         self.assertIsInstance(res[0], TaskExecution)
         self.assertEqual(len(res), 1)
 
-    def test_is_known_task(self):
-        qh = MagicMock(task_timeout=60)
-        ts = TaskConsumer(qh, {"test_task": MagicMock()}, max_workers=2)
+    @patch.object(tasks.consumers, "_logger")
+    def test_get_new_tasks_unknown(self, l):
+        qh = Mock(task_timeout=60, max_receive_count=None)
+        ts = TaskConsumer(qh, _task_map(), max_workers=2, unknown_tasks_retries=3)
+        m1 = Mock(message_attributes={"task_name": {"StringValue": "other_task"}},
+                       attributes={'ApproximateReceiveCount': 1})
+        m2 = Mock(message_attributes={"task_name": {}}, attributes={'ApproximateReceiveCount': 1})
+        m3 = Mock(message_attributes=None, attributes={'ApproximateReceiveCount': 4})
+        for m in (m1, m2, m3):
+            ts._received.put((m, datetime.utcnow()))
+
+        self.assertEqual(ts._get_new_tasks(5), [])
+        self.assertEqual(l.warn.call_count, 3)
+        self.assertEqual(qh.postpone_later.call_count, 2)
+        qh.done_later.assert_called_once_with(m3)
+
+        # With a dead letter queue, unknown task messages are left to the redrive policy
+        qh.reset_mock()
+        qh.max_receive_count = 50
+        for m in (m1, m3):
+            ts._received.put((m, datetime.utcnow()))
+        self.assertEqual(ts._get_new_tasks(5), [])
+        qh.postpone_later.assert_not_called()
+        qh.done_later.assert_not_called()
+
+    def test_reserve_receive(self):
+        qh = Mock(task_timeout=60)
+        ts = TaskConsumer(qh, _task_map(), workers=25)
+        self.assertEqual(ts._reserve_receive(), 0)
+        ts.status = ts.statuses.RUNNING
+        ts._on_going_tasks = {"a": Mock(), "b": Mock()}
+        self.assertEqual(ts._reserve_receive(), 10)
+        self.assertEqual(ts._reserve_receive(), 10)
+        ts._received.put((Mock(), datetime.utcnow()))
+        self.assertEqual(ts._reserve_receive(), 2)
+        self.assertEqual(ts._reserve_receive(), 0)
+        self.assertEqual(ts._receiving, 22)
 
-        self.assertTrue(ts._is_known_task(MagicMock(message_attributes={"task_name": {"StringValue": "test_task"}})))
-        self.assertFalse(ts._is_known_task(MagicMock(message_attributes="wrong")))
+        ts = TaskConsumer(qh, _task_map(), workers=5, prefetch_multiplier=3)
+        ts.status = ts.statuses.RUNNING
+        ts._on_going_tasks = {"a": Mock(), "b": Mock()}
+        self.assertEqual(ts._reserve_receive(), 10)
+        self.assertEqual(ts._reserve_receive(), 3)
+        self.assertEqual(ts._reserve_receive(), 0)
+
+    def test_receive_loop(self):
+        qh = Mock(task_timeout=60)
+        ts = TaskConsumer(qh, _task_map(), workers=2)
+        ts.status = ts.statuses.RUNNING
+
+        def retrieve(num):
+            ts.status = ts.statuses.STOPPED
+            return ["m1", "m2"][:num]
+        qh.retrieve.side_effect = retrieve
+        ts._receive_loop()
+        qh.retrieve.assert_called_once_with(2)
+        # Messages received after the consumer stopped are released
+        qh.postpone.assert_any_call("m1", 0)
+        qh.postpone.assert_any_call("m2", 0)
+        self.assertEqual(ts._receiving, 0)
+        self.assertTrue(ts._received.empty())
+
+    def test_release_received(self):
+        qh = Mock(task_timeout=60)
+        ts = TaskConsumer(qh, _task_map())
+        ts._received.put(("m1", datetime.utcnow()))
+        ts._release_received()
+        qh.postpone.assert_called_once_with("m1", 0)
+        self.assertTrue(ts._received.empty())
 
     @patch.object(tasks.consumers, "_logger")
     def test_process_dead_thread(self, l):
-        qh = MagicMock(task_timeout=60)
-        te = MagicMock(disabled=True, exec_id="id", message="message", job_id="id", job_name="name")
+        qh = Mock(task_timeout=60)
+        te = Mock(disabled=True, exec_id="id", message="message", job_id="id", job_name="name")
         te.task.name = "test_task"
-        ts = TaskConsumer(qh, {"test_task": MagicMock()}, max_workers=2)
+        ts = TaskConsumer(qh, _task_map(), max_workers=2)
         ts._on_going_tasks[te.exec_id] = te
         ts._process_dead_thread(te, [])
         l.error.assert_called_once_with('DEAD_THREAD: test_task id', job_id='id', job_name='name')
-        qh.done.assert_called_once_with("message")
+        qh.done_later.assert_called_once_with("message")
 
-    def test_passed_when(self):
-        qh = MagicMock(task_timeout=60)
-        te = MagicMock(disabled=True, exec_id="id", message="message")
+    @patch.object(time, "time", return_value=_NOW)
+    def test_passed_when(self, _):
+        qh = Mock(task_timeout=60)
+        te = Mock(disabled=True, exec_id="id", message="message")
         te.task.name = "test_task"
-        ts = TaskConsumer(qh, {"test_task": MagicMock()}, max_workers=2, when_window=60)
-        m = MagicMock(
+        ts = TaskConsumer(qh, _task_map(), max_workers=2, when_window=60)
+        m = SimpleNamespace(
             message_attributes={
                 "when": {
-                    "StringValue": (datetime.utcnow() + timedelta(seconds=30)).strftime("%d/%m/%y %H:%M:%S")
+                    "StringValue": _when(30)
                 },
                 "exec_id": {
                     "StringValue": "exec_id"
@@ -112,10 +247,10 @@ class TaskConsumerTest(unittest.TestCase):
             }
         )
         self.assertTrue(ts._passed_when(m))
-        m = MagicMock(
+        m = SimpleNamespace(
             message_attributes={
                 "when": {
-                    "StringValue": (datetime.utcnow() + timedelta(seconds=90)).strftime("%d/%m/%y %H:%M:%S")
+                    "StringValue": _when(90)
                 },
                 "exec_id": {
                     "StringValue": "exec_id"
@@ -124,11 +259,10 @@ class TaskConsumerTest(unittest.TestCase):
         )
         self.assertFalse(ts._passed_when(m))
         with patch.object(tasks.consumers, "_logger") as l:
-            now = (datetime.utcnow() - timedelta(seconds=30))
-            m = MagicMock(
+            m = SimpleNamespace(
                 message_attributes={
                     "when": {
-                        "StringValue": now.strftime("%d/%m/%y %H:%M:%S")
+                        "StringValue": _when(-30)
                     },
                     "exec_id": {
                         "StringValue": "test"
@@ -137,68 +271,101 @@ class TaskConsumerTest(unittest.TestCase):
             )
             self.assertTrue(ts._passed_when(m))
             self.assertEqual(l.warn.call_count, 1)
+        # Epoch seconds, as sent by the queue handler
+        m = SimpleNamespace(
+            message_attributes={"when": {"StringValue": str(int(_NOW) + 30)}, "exec_id": {"StringValue": "id"}}
+        )
+        self.assertTrue(ts._passed_when(m))
+        m = SimpleNamespace(
+            message_attributes={"when": {"StringValue": str(int(_NOW) + 90)}, "exec_id": {"StringValue": "id"}}
+        )
+        self.assertFalse(ts._passed_when(m))
+
+    def test_message_when(self):
+        m = SimpleNamespace(message_attributes={"when": {"StringValue": "10/07/18 12:30:00"}})
+        self.assertEqual(tasks.consumers._message_when(m), 1531225800)
+        m.message_attributes["when_epoch"] = {"StringValue": "1531225860"}
+        self.assertEqual(tasks.consumers._message_when(m), 1531225860)
 
-    def test_when_to_seconds(self):
-        qh = MagicMock(task_timeout=60)
-        te = MagicMock(disabled=True, exec_id="id", message="message")
+    def test_no_when(self):
+        ts = TaskConsumer(Mock(task_timeout=60), _task_map())
+        m = SimpleNamespace(message_attributes={"exec_id": {"StringValue": "exec_id"}})
+        self.assertIsNone(tasks.consumers._message_when(m))
+        self.assertTrue(ts._passed_when(m))
+        self.assertEqual(ts._when_to_seconds(m), 0)
+
+    def test_parse_when(self):
+        self.assertEqual(tasks.consumers._parse_when("23/02/90 14:00:00"), datetime(1990, 2, 23, 14, 0, 0))
+        self.assertEqual(tasks.consumers._parse_when("01/12/18 09:05:59"), datetime(2018, 12, 1, 9, 5, 59))
+        self.assertEqual(tasks.consumers._parse_when("31/01/68 23:59:01"), datetime(2068, 1, 31, 23, 59, 1))
+        with self.assertRaises(ValueError):
+            tasks.consumers._parse_when("32/01/18 10:00:00")
+        with self.assertRaises(ValueError):
+            tasks.consumers._parse_when("tomorrow")
+
+    @patch.object(time, "time", return_value=_NOW)
+    def test_when_to_seconds(self, _):
+        qh = Mock(task_timeout=60)
+        te = Mock(disabled=True, exec_id="id", message="message")
         te.task.name = "test_task"
-        ts = TaskConsumer(qh, {"test_task": MagicMock()}, when_window=5)
-        when = (datetime.utcnow() + timedelta(seconds=30))
-        m = MagicMock(
+        ts = TaskConsumer(qh, _task_map(), when_window=5)
+        m = SimpleNamespace(
             message_attributes={
                 "when": {
-                    "StringValue": when.strftime("%d/%m/%y %H:%M:%S")
+                    "StringValue": _when(30)
                 }
             }
         )
         self.assertEqual(25, ts._when_to_seconds(m))
-        when = (datetime.utcnow() + timedelta(seconds=25000))
-        m = MagicMock(
+        m = SimpleNamespace(
             message_attributes={
                 "when": {
-                    "StringValue": when.strftime("%d/%m/%y %H:%M:%S")
+                    "StringValue": _when(25000)
                 }
             }
         )
         self.assertEqual(18000, ts._when_to_seconds(m))
+        m = SimpleNamespace(message_attributes={"when": {"StringValue": str(int(_NOW) + 30)}})
+        self.assertEqual(25, ts._when_to_seconds(m))
+        self.assertEqual(25, ts._when_to_seconds(None, int(_NOW) + 30))
 
     def test_process_task_results(self):
-        qh = MagicMock(task_timeout=60)
-        te = MagicMock(disabled=True, exec_id="id", message="message")
+        qh = Mock(task_timeout=60)
+        te = Mock(disabled=True, exec_id="id", message="message")
         te.task.name = "test_task"
-        ts = TaskConsumer(qh, {"test_task": MagicMock()})
+        ts = TaskConsumer(qh, _task_map())
         # Success
-        task_exec = MagicMock(results=True, exec_id="test", message="Help")
+        task_exec = Mock(results=True, exec_id="test", message="Help")
         bt = []
         ts._process_task_results(task_exec, bt)
-        qh.done.assert_called_once_with("Help")
+        qh.done_later.assert_called_once_with("Help")
         self.assertEqual([task_exec.exec_id], bt)
         # Failure
-        task_exec = MagicMock(results=False, exec_id="test", message="Help", created_at=datetime.utcnow(), attempts=1)
+        task_exec = Mock(results=False, exec_id="test", message="Help", created_epoch=_NOW - 5, attempts=1)
         task_exec.task.get_delay.return_value = 10
         bt = []
-        ts._process_task_results(task_exec, bt)
-        qh.done.assert_called_once_with("Help")
+        ts._process_task_results(task_exec, bt, now=_NOW)
+        qh.done_later.assert_called_once_with("Help")
         self.assertEqual([task_exec.exec_id], bt)
-        self.assertEqual(qh.postpone.call_count, 1)
+        qh.postpone_later.assert_called_once_with("Help", 15)
 
     def test_postpone_failed(self):
-        qh = MagicMock(task_timeout=60)
-        ts = TaskConsumer(qh, {"test_task": MagicMock()})
-        te = MagicMock(results=True, exec_id="test", message="Help", disabled=False, attr="attr")
+        qh = Mock(task_timeout=60)
+        ts = TaskConsumer(qh, _task_map())
+        te = Mock(results=True, exec_id="test", message="Help", disabled=False, attr="attr")
         bt = []
         ts._postpone_failed(te, bt)
         te.task.issue.assert_called_once_with("attr", 0, "test")
         self.assertTrue(te.disabled)
-        qh.done.assert_called_once_with("Help")
+        qh.done_later.assert_called_once_with("Help")
         self.assertEqual([te.exec_id], bt)
 
     def test_process_on_going_tasks(self):
-        qh = MagicMock(task_timeout=60)
-        tt = MagicMock()
+        qh = Mock(task_timeout=60)
+        tt = Mock()
         ts = TaskConsumer(qh, {"test_task": tt})
         # Test first check
-        te = MagicMock(
+        te = Mock(
             results=True,
             exec_id="test",
             message="Help",
@@ -210,57 +377,91 @@ class TaskConsumerTest(unittest.TestCase):
         }
         with patch.object(ts, "_process_task_results") as p:
             ts._process_on_going_tasks()
-            p.assert_called_once_with(te, [])
+            p.assert_called_once_with(te, [], now=ANY)
         # Test second check
-        te = MagicMock(
-            results=None,
-            exec_id="test",
-            message="Help",
-            created_at=datetime.utcnow(),
-            attempts=1
-        )
-        te.thread.is_alive.return_value = False
-        ts._on_going_tasks = {
-            "test": te
-        }
+        te.reset_mock()
+        te.results = None
+        te.finished = True
+        ts._on_going_tasks = {"test": te}
         with patch.object(ts, "_process_dead_thread") as p:
             ts._process_on_going_tasks()
-            p.assert_called_once_with(te, [])
+            p.assert_called_once_with(te, [], now=ANY)
         # Test third check
-        te = MagicMock(
-            results=None,
-            exec_id="test",
-            message="Help",
-            created_at=datetime.utcnow(),
-            attempts=1
-        )
-        te.thread.is_alive.return_value = True
-        te.get_deadline.return_value = datetime.utcnow() - timedelta(seconds=30)
-        te.postpone.return_value = False
-        ts._on_going_tasks = {
-            "test": te
-        }
+        te.reset_mock()
+        te.finished = False
+        te.deadline_epoch = time.time() - 30
+        te.extend.return_value = 45
+        ts._on_going_tasks = {"test": te}
         with patch.object(ts, "_postpone_failed") as p:
+            ts._process_on_going_tasks()
+            p.assert_not_called()
+            qh.postpone.assert_not_called()
+            self.assertEqual(list(ts._extensions), [(te, 45)])
+            # Failed extensions are handed back by the extender thread
+            ts._failed_extensions.append(te)
             ts._process_on_going_tasks()
             p.assert_called_once_with(te, [])
 
+    def test_extender_loop(self):
+        qh = Mock(task_timeout=60)
+        ts = TaskConsumer(qh, _task_map())
+        ts.status = ts.statuses.RUNNING
+        tes = [Mock(message="m{}".format(i)) for i in range(12)]
+        ts._extensions.extend((te, 30) for te in tes)
+
+        def postpone_batch(postpones):
+            if len(postpones) < 10:
+                ts.status = ts.statuses.STOPPED
+            return {0}
+        qh.postpone_batch.side_effect = postpone_batch
+        ts._extender_loop()
+        self.assertEqual(qh.postpone_batch.call_count, 2)
+        qh.postpone_batch.assert_any_call([("m{}".format(i), 30) for i in range(10)])
+        qh.postpone_batch.assert_called_with([("m10", 30), ("m11", 30)])
+        self.assertEqual(list(ts._failed_extensions), [tes[0], tes[10]])
+        self.assertEqual(len(ts._extensions), 0)
+        self.assertTrue(ts._wakeup.is_set())
+
     def test_loop_stopped(self):
-        qh = MagicMock(task_timeout=60)
-        tt = MagicMock()
+        qh = Mock(task_timeout=60)
+        tt = Mock()
         ts = TaskConsumer(qh, {"test_task": tt})
         ts.status == ts.statuses.STOPPED
         with patch.object(tasks.consumers, "_logger") as l:
             ts.loop()
             l.debug.assert_called_with("Getting out of loop")
 
+    def test_loop_joins_threads(self):
+        qh = Mock(task_timeout=60)
+        ts = TaskConsumer(qh, {"test_task": Mock()})
+        threads = [Mock(), Mock(), Mock()]
+        ts._receiver_threads = threads[:1]
+        ts._extender_thread, ts._scaling_thread = threads[1:]
+        ts.loop()
+        for thread in threads:
+            thread.join.assert_called_once_with()
+        self.assertEqual(ts._receiver_threads, [])
+        self.assertIsNone(ts._extender_thread)
+        self.assertIsNone(ts._scaling_thread)
+
+    def test_loop_drained(self):
+        qh = Mock(task_timeout=60)
+        ts = TaskConsumer(qh, {"test_task": Mock()})
+        ts.status = ts.statuses.STOPPING
+        statuses = []
+        qh.flush_deletes.side_effect = lambda: statuses.append(ts.status)
+        ts.loop()
+        self.assertEqual(statuses[0], ts.statuses.STOPPING)
+        self.assertEqual(ts.status, ts.statuses.STOPPED)
+
     def test_process_scaling_none(self):
-        qh = MagicMock(task_timeout=60)
-        tt = MagicMock()
+        qh = Mock(task_timeout=60)
+        tt = Mock()
         ts = TaskConsumer(qh, {"test_task": tt})
         ts.status == ts.statuses.STOPPED
         with patch.object(tasks.consumers, "_logger") as l:
             ts.max_workers = None
-            ts.queue_handler = MagicMock()
+            ts.queue_handler = Mock()
             ts.queue_handler.queue_len.return_value = 100
             ts.workers = 2
             ts.scale_factor = 100
@@ -268,13 +469,13 @@ class TaskConsumerTest(unittest.TestCase):
             self.assertEqual(ts.workers, 2)
 
     def test_process_scaling_down(self):
-        qh = MagicMock(task_timeout=60)
-        tt = MagicMock()
+        qh = Mock(task_timeout=60)
+        tt = Mock()
         ts = TaskConsumer(qh, {"test_task": tt})
         ts.status == ts.statuses.STOPPED
         with patch.object(tasks.consumers, "_logger") as l:
             ts.max_workers = 3
-            ts.queue_handler = MagicMock()
+            ts.queue_handler = Mock()
             ts.queue_handler.queue_len.return_value = 100
             ts.workers = 2
             ts.scale_factor = 100
@@ -282,17 +483,38 @@ class TaskConsumerTest(unittest.TestCase):
             self.assertEqual(ts.workers, 1)
 
     def test_process_scaling_up(self):
-        qh = MagicMock(task_timeout=60)
-        tt = MagicMock()
+        qh = Mock(task_timeout=60)
+        tt = Mock()
         ts = TaskConsumer(qh, {"test_task": tt})
         ts.status == ts.statuses.STOPPED
         with patch.object(tasks.consumers, "_logger") as l:
             ts.max_workers = 3
-            ts.queue_handler = MagicMock()
+            ts.queue_handler = Mock()
             ts.queue_handler.queue_len.return_value = 300
             ts.workers = 2
             ts.scale_factor = 100
             ts._process_scaling()
             self.assertEqual(ts.workers, 3)
 
+            ts.max_workers = 20
+            ts.queue_handler.queue_len.return_value = 1240
+            ts._process_scaling()
+            self.assertEqual(ts.workers, 12)
+            ts.queue_handler.queue_len.return_value = 5000
+            ts._process_scaling()
+            self.assertEqual(ts.workers, 20)
+
+    def test_scaling_loop(self):
+        qh = Mock(task_timeout=60)
+        qh.queue_len.return_value = 300
+        ts = TaskConsumer(qh, _task_map(), workers=1, max_workers=3, scaling_interval=0)
 
+        def queue_len():
+            if ts.workers == 3:
+                ts.status = ts.statuses.STOPPED
+            return 300
+        qh.queue_len.side_effect = queue_len
+        ts.status = ts.statuses.RUNNING
+        ts._scaling_loop()
+        self.assertEqual(ts.workers, 3)
+        self.assertEqual(qh.queue_len.call_count, 2)
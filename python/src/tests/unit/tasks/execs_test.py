@@ -6,37 +6,55 @@ Copyright (c) SambaTech. All rights reserved.
 created_at: 11-JUN-2018
 updated_at: 11-JUL-2018
 """
-from samba_chassis import tasks
-from samba_chassis.tasks import *
-from mock import MagicMock, patch, ANY
+from samba_chassis.tasks import TaskExecution
+from mock import Mock
 import unittest
-import boto3
 from datetime import datetime, timedelta
-import warnings
 
 
 class TaskExecutionTest(unittest.TestCase):
 
     def test_execute(self):
-        te = TaskExecution("1", MagicMock(execute=lambda: True), {1: {"one"}},
-                           1, datetime.utcnow(), MagicMock(), 30, "id", "name")
+        te = TaskExecution("1", Mock(execute=lambda: True), {1: {"one"}},
+                           1, datetime.utcnow(), Mock(), 30, "id", "name")
         te.execute()
         te.task.run.assert_called_with({1: {"one"}}, 0, job_id='id', job_name='name')
+        te.execute("pool")
+        te.task.run.assert_called_with({1: {"one"}}, 0, job_id='id', job_name='name', executor="pool")
+
+    def test_slots(self):
+        te = TaskExecution("1", Mock(), {}, 1, datetime.utcnow(), Mock(), 30, "id", "name")
+        self.assertFalse(hasattr(te, "__dict__"))
 
     def test_get_deadline(self):
         now = datetime.utcnow()
-        te = TaskExecution("1", MagicMock(execute=lambda: True), {1: {"one"}}, 1, now, MagicMock(), 30, "id", "name")
+        te = TaskExecution("1", Mock(execute=lambda: True), {1: {"one"}}, 1, now, Mock(), 30, "id", "name")
         deadline = te.get_deadline()
         self.assertEqual(deadline, now + timedelta(seconds=15))
+        self.assertEqual(te.deadline_epoch, (deadline - datetime(1970, 1, 1)).total_seconds())
+        self.assertEqual(te.created_epoch, (now - datetime(1970, 1, 1)).total_seconds())
 
-        te = TaskExecution("1", MagicMock(execute=lambda: True), {1: {"one"}}, 1, now, MagicMock(), 60, "id", "name")
+        te = TaskExecution("1", Mock(execute=lambda: True), {1: {"one"}}, 1, now, Mock(), 60, "id", "name")
         te.postpone_num = 3
         deadline = te.get_deadline()
         self.assertEqual(deadline, now + timedelta(seconds=120))
 
     def test_postpone(self):
         now = datetime.utcnow()
-        te = TaskExecution("1", MagicMock(execute=lambda: True), {1: {"one"}}, 1, now, "message", 30, "id", "name")
-        qh = MagicMock()
-        te.postpone(qh)
-        qh.postpone.assert_called_with("message", 45)
\ No newline at end of file
+        te = TaskExecution("1", Mock(execute=lambda: True), {1: {"one"}}, 1, now, "message", 30, "id", "name")
+        qh = Mock()
+        self.assertTrue(te.postpone(qh))
+        qh.postpone.assert_called_with("message", 45)
+        self.assertEqual(te.postpone_num, 1)
+        self.assertEqual(te.deadline_epoch, (now - datetime(1970, 1, 1)).total_seconds() + 30)
+
+        qh.postpone.return_value = False
+        self.assertFalse(te.postpone(qh))
+        self.assertEqual(te.postpone_num, 1)
+
+    def test_extend(self):
+        now = datetime.utcnow()
+        te = TaskExecution("1", Mock(execute=lambda: True), {1: {"one"}}, 1, now, "message", 30, "id", "name")
+        self.assertEqual(te.extend((now - datetime(1970, 1, 1)).total_seconds()), 45)
+        self.assertEqual(te.postpone_num, 1)
+        self.assertEqual(te.deadline_epoch, (now - datetime(1970, 1, 1)).total_seconds() + 30)
\ No newline at end of file
@@ -8,16 +8,33 @@ updated_at: 11-JUL-2018
 """
 from samba_chassis import tasks
 from samba_chassis.tasks.consumers import TaskConsumer
-from mock import MagicMock, patch, ANY
+from mock import Mock, MagicMock
 import unittest
 import warnings
 
 
+# Module globals the tests replace, restored after each test
+_globals = ("_logger", "_config", "_consumer", "_consumer_class", "_queue_pool", "_tasks", "_pending_tasks",
+            "_warned", "_task_class", "_queue_class")
+
+
 class ModuleTest(unittest.TestCase):
 
-    @patch.object(tasks, "_queue_class")
-    def test_config(self, q):
-        co = MagicMock(
+    def setUp(self):
+        # Plain attribute swaps, cheaper than stacking patch.object decorators on every test
+        self._saved = {name: getattr(tasks, name) for name in _globals}
+        tasks._queue_pool = {}
+        tasks._tasks = {}
+        tasks._pending_tasks = []
+        tasks._warned = set()
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(tasks, name, value)
+
+    def test_config(self):
+        q = tasks._queue_class = Mock()
+        co = Mock(
             task_pool="test",
             workers=5,
             task_timeout=120,
@@ -25,27 +42,40 @@ class ModuleTest(unittest.TestCase):
             unknown_tasks_delay=10,
             max_workers=6,
             scale_factor=100,
-            when_window=300
+            when_window=300,
+            pool_type="thread",
+            max_receive_count=0,
+            scaling_interval=60
         )
-        with warnings.catch_warnings():
-            tasks.config(co)
-            self.assertEqual(tasks._config.task_pool, "test")
-            self.assertEqual(tasks._config.task_timeout, 120)
-            self.assertEqual(tasks._config.workers, 5)
-            self.assertEqual(tasks._config.unknown_tasks_retries, 50)
-            self.assertEqual(tasks._config.unknown_tasks_delay, 10)
-            self.assertEqual(tasks._config.max_workers, 6)
-            self.assertEqual(tasks._config.scale_factor, 100)
-            self.assertEqual(tasks._config.when_window, 300)
-            assert "test" in tasks._queue_pool
-            q.assert_called_once_with("test", 120)
-
-    @patch.object(tasks, "_logger")
-    @patch.object(tasks, "_config")
-    @patch.object(tasks, "_consumer")
-    @patch.object(tasks, "_consumer_class")
-    @patch.object(tasks, "_queue_pool")
-    def test_start_consumer(self, *_):
+        tasks.config(co)
+        self.assertEqual(tasks._config.task_pool, "test")
+        self.assertEqual(tasks._config.task_timeout, 120)
+        self.assertEqual(tasks._config.workers, 5)
+        self.assertEqual(tasks._config.unknown_tasks_retries, 50)
+        self.assertEqual(tasks._config.unknown_tasks_delay, 10)
+        self.assertEqual(tasks._config.max_workers, 6)
+        self.assertEqual(tasks._config.scale_factor, 100)
+        self.assertEqual(tasks._config.when_window, 300)
+        self.assertEqual(tasks._config.pool_type, "thread")
+        self.assertEqual(tasks._config.scaling_interval, 60)
+        assert "test" in tasks._queue_pool
+        q.assert_called_once_with("test", 120)
+
+    def test_config_max_receive_count(self):
+        q = tasks._queue_class = Mock()
+        tasks.config(Mock(
+            task_pool="test", workers=5, task_timeout=120, unknown_tasks_retries=50, unknown_tasks_delay=10,
+            max_workers=6, scale_factor=100, when_window=300, pool_type="thread", max_receive_count=5,
+            scaling_interval=60
+        ))
+        q.assert_called_once_with("test", 120, 5)
+
+    def test_start_consumer(self):
+        tasks._logger = Mock()
+        tasks._config = Mock()
+        tasks._consumer = Mock()
+        tasks._consumer_class = Mock()
+        tasks._queue_pool = MagicMock()
         tasks._config.name = "tasks"
         tasks._config.project = "test"
         tasks._config.workers = 1
@@ -54,9 +84,35 @@ class ModuleTest(unittest.TestCase):
         tasks._config.max_workers = 4
         tasks._config.scale_factor = 5
         tasks._config.when_window = 6
+        tasks._config.pool_type = "process"
+        tasks._config.scaling_interval = 7
         tasks._consumer = None
         tasks.start_consumer()
         tasks._logger.debug.assert_called_once_with("Starting consumer")
+        tasks._consumer_class.assert_called_once_with(
+            tasks._queue_pool["test_tasks"],
+            tasks._tasks,
+            workers=1,
+            unknown_tasks_retries=2,
+            unknown_tasks_delay=3,
+            max_workers=4,
+            scale_factor=5,
+            when_window=6,
+            pool_type="process",
+            scaling_interval=7
+        )
+
+    def test_start_consumer_defaults(self):
+        tasks._logger = Mock()
+        tasks._consumer = None
+        tasks._consumer_class = Mock()
+        tasks._queue_pool = MagicMock()
+        tasks._config = Mock(
+            task_pool="test_tasks", workers=1, unknown_tasks_retries=2, unknown_tasks_delay=3, max_workers=4,
+            scale_factor=5, when_window=6, pool_type="thread", scaling_interval=10
+        )
+        tasks.start_consumer()
+        # Unchanged settings are left to the consumer class
         tasks._consumer_class.assert_called_once_with(
             tasks._queue_pool["test_tasks"],
             tasks._tasks,
@@ -68,9 +124,30 @@ class ModuleTest(unittest.TestCase):
             when_window=6
         )
 
-    @patch.object(tasks, "_logger")
-    @patch.object(tasks, "_consumer")
-    def test_stop_consumer(self, *_):
+    def test_warn_once(self):
+        tasks._logger = Mock()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            tasks._warn_once("REGISTERED_TASK_OVERWRITTEN: t")
+            tasks._warn_once("REGISTERED_TASK_OVERWRITTEN: t")
+        self.assertEqual(len(caught), 1)
+        tasks._logger.warning.assert_called_once_with("REGISTERED_TASK_OVERWRITTEN: t")
+
+    def test_start_consumer_running(self):
+        tasks._logger = Mock()
+        tasks._config = Mock()
+        tasks._consumer = Mock()
+        tasks._consumer_class = TaskConsumer
+        tasks._consumer.status = TaskConsumer.statuses.RUNNING
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter("always")
+            tasks.start_consumer()
+        tasks._logger.warning.assert_called_once_with("CONSUMER_ALREADY_RUNNING")
+        tasks._consumer.start.assert_not_called()
+
+    def test_stop_consumer(self):
+        tasks._logger = Mock()
+        tasks._consumer = Mock()
         tasks._consumer.status = TaskConsumer.statuses.RUNNING
         tasks._consumer_class = TaskConsumer
         tasks.stop_consumer()
@@ -81,8 +158,8 @@ class ModuleTest(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             tasks.stop_consumer()
 
-    @patch.object(tasks, "_consumer")
-    def test_is_consumer_running(self, *_):
+    def test_is_consumer_running(self):
+        tasks._consumer = Mock()
         tasks._consumer.status = TaskConsumer.statuses.RUNNING
         self.assertTrue(tasks.is_consumer_running())
 
@@ -96,30 +173,25 @@ class ModuleTest(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             tasks.is_consumer_running()
 
-    @patch.object(tasks, "_logger")
-    @patch.object(tasks, "_tasks")
-    @patch.object(tasks, "_task_class")
-    @patch.object(tasks, "_config")
-    @patch.object(tasks, "_queue_pool")
-    def test_set_task(self, *_):
-        tasks._tasks = {}
-        qh = MagicMock()
+    def test_set_task(self):
+        tasks._logger = Mock()
+        tasks._task_class = Mock()
+        tasks._config = Mock()
+        qh = Mock()
         tasks._queue_pool = {"tasks": qh}
         tasks._config.task_pool = "tasks"
-        f = MagicMock()
+        f = Mock()
         tasks.set_task("test", f, max_retries=10, on_fail=None, wait_time=10, wait_progression="NONE")
         tasks._task_class.assert_called_once_with(
             "test", f, qh, 10, None, 10, "NONE"
         )
 
-    @patch.object(tasks, "_tasks")
-    @patch.object(tasks, "_task_class")
-    @patch.object(tasks, "_config")
-    @patch.object(tasks, "_queue_pool")
-    @patch.object(tasks, "_queue_class")
-    def test_run(self, *_):
-        qh = MagicMock()
-        tasks._tasks = {"test": MagicMock()}
+    def test_run(self):
+        tasks._task_class = Mock()
+        tasks._config = Mock()
+        tasks._queue_class = Mock()
+        qh = Mock()
+        tasks._tasks = {"test": Mock(queue_handler=qh)}
         tasks._queue_pool = {"tasks": qh}
         tasks._config.task_pool = "tasks"
         tasks.run("test", {"one": 1}, task_pool=None, when="23/02/1990 14:00:00")
@@ -133,17 +205,116 @@ class ModuleTest(unittest.TestCase):
             "test", {"one": 1}, tasks._queue_pool["test"], when="23/02/1990 14:00:00"
         )
 
+        tasks._queue_class.reset_mock()
+        tasks.run("test", {"one": 1}, task_pool="test")
+        tasks._queue_class.assert_not_called()
+
         tasks._tasks = {}
         with self.assertRaises(RuntimeError):
             tasks.run("test", {"one": 1}, service_name=None, project_name=None, when="23/02/1990 14:00:00")
 
-    @patch.object(tasks, "_queue_pool")
-    @patch.object(tasks, "_consumer")
-    def test_ready(self, *_):
+    def test_set_tasks(self):
+        tasks._logger = Mock()
+        t = tasks._task_class = Mock()
+        tasks._config = None
+        q = tasks._queue_class = Mock()
+        f = Mock()
+        # Registered once the module is configured
+        tasks.set_tasks([("one", f), ("two", f, 3)])
+        self.assertEqual(tasks._tasks, {})
+        tasks.config(Mock(
+            task_pool="test", workers=5, task_timeout=120, unknown_tasks_retries=50, unknown_tasks_delay=10,
+            max_workers=6, scale_factor=100, when_window=300, pool_type="thread", max_receive_count=0,
+            scaling_interval=60
+        ))
+        t.assert_any_call("one", f, q.return_value)
+        t.assert_any_call("two", f, q.return_value, 3)
+        self.assertEqual(set(tasks._tasks), {"one", "two"})
+        self.assertEqual(tasks._pending_tasks, [])
+
+    def test_set_tasks_pending_invalid(self):
+        tasks._logger = Mock()
+        tasks._task_class = tasks.Task
+        tasks._config = None
+        f = Mock()
+        # Invalid specs fail when queued and leave the others pending
+        tasks.set_tasks([("one", f)])
+        self.assertRaises(ValueError, tasks.set_tasks, [("two", f, 3, None, 10, "WRONG")])
+        self.assertRaises(TypeError, tasks.set_tasks, [("three",)])
+        self.assertEqual(tasks._pending_tasks, [("one", f)])
+
+    def test_config_pending_failed(self):
+        tasks._logger = Mock()
+        tasks._task_class = Mock(side_effect=ValueError)
+        tasks._config = None
+        tasks._queue_class = Mock()
+        f = Mock()
+        tasks.set_tasks([("one", f), ("two", f, 3)])
+        # Pending registrations are kept when registering them fails
+        self.assertRaises(ValueError, tasks.config, Mock(
+            task_pool="test", workers=5, task_timeout=120, unknown_tasks_retries=50, unknown_tasks_delay=10,
+            max_workers=6, scale_factor=100, when_window=300, pool_type="thread", max_receive_count=0,
+            scaling_interval=60
+        ))
+        self.assertEqual(tasks._tasks, {})
+        self.assertEqual(tasks._pending_tasks, [("one", f), ("two", f, 3)])
+
+    def test_run_many(self):
+        tasks._config = Mock()
+        tasks._queue_class = MagicMock()
+        qh = Mock()
+        tasks._tasks = {"test": Mock(queue_handler=qh)}
+        tasks._queue_pool = {"tasks": Mock()}
+        tasks._config.task_pool = "tasks"
+        qh.send_many.side_effect = lambda sends, **kwargs: [sends[1]]
+        runs = [("test", {"one": 1}), ("test", {"two": 2}, "when")]
+        self.assertEqual(tasks.run_many(runs, job_id="42"), [runs[1]])
+        qh.send_many.assert_called_once_with(
+            [("test", {"one": 1}, 0, None, None), ("test", {"two": 2}, 0, None, "when")], job_id="42"
+        )
+
+        tasks.run_many([("other", {})], task_pool="other_pool")
+        tasks._queue_class.assert_called_once_with("other_pool")
+        tasks._queue_pool["other_pool"].send_many.assert_called_once_with([("other", {}, 0, None, None)])
+
+        with self.assertRaises(RuntimeError):
+            tasks.run_many([("other", {})])
+
+    def test_deferred_runs(self):
+        tasks._config = Mock()
+        tasks._task_class = Mock()
+        qh = Mock()
+        tasks._tasks = {"test": Mock(queue_handler=qh)}
+        tasks._config.task_pool = "tasks"
+        qh.send_many.return_value = []
+        with tasks.deferred_runs():
+            tasks.run("test", {"one": 1}, job_id="42")
+            with tasks.deferred_runs():
+                tasks.run("test", {"two": 2}, when="when", job_id="42")
+            tasks.run("test", {"three": 3})
+            qh.send_many.assert_not_called()
+        tasks._task_class.send.assert_not_called()
+        qh.send_many.assert_any_call(
+            [("test", {"one": 1}, 0, None, None), ("test", {"two": 2}, 0, None, "when")], job_id="42"
+        )
+        qh.send_many.assert_any_call([("test", {"three": 3}, 0, None, None)])
+
+        qh.send_many.return_value = [("test", {}, 0, None, None)]
+        with self.assertRaises(RuntimeError):
+            with tasks.deferred_runs():
+                tasks.run("test", {})
+        tasks.run("test", {})
+        tasks._task_class.send.assert_called_once_with("test", {}, qh, when=None)
+
+    def test_ready(self):
+        tasks._consumer = Mock()
         tasks._consumer.get_status.return_value = TaskConsumer.statuses.RUNNING
-        tasks._queue_pool = {"test": MagicMock()}
+        tasks._queue_pool = {"test": Mock()}
         self.assertEqual(tasks.ready(), {"TASK_QUEUES": "OK", "TASK_CONSUMER": "OK"})
 
+        tasks._consumer.get_status.return_value = TaskConsumer.statuses.STOPPED
+        self.assertEqual(tasks.ready(), {"TASK_QUEUES": "OK", "TASK_CONSUMER": "ERROR"})
+
         tasks._consumer = None
         tasks._queue_pool = {}
         self.assertEqual(tasks.ready(), {"TASK_QUEUES": "ERROR", "TASK_CONSUMER": "ERROR"})
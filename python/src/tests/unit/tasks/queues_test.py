@@ -6,29 +6,102 @@ Copyright (c) SambaTech. All rights reserved.
 created_at: 11-JUN-2018
 updated_at: 11-JUL-2018
 """
-from samba_chassis.tasks import *
-from mock import MagicMock, patch
+from samba_chassis import tasks
+from samba_chassis.tasks import QueueHandler
+from mock import Mock, MagicMock, patch, ANY
 import unittest
 import boto3
+from botocore.exceptions import ClientError, EndpointConnectionError
 from datetime import datetime
 import warnings
+import json
+import time
 
 
 class QueueHandlerTest(unittest.TestCase):
 
-    @patch.object(boto3, "client")
-    @patch.object(boto3, "resource")
-    def test_queue(self, *args):
+    @classmethod
+    def setUpClass(cls):
+        # Patch boto3 once for the whole class, setUp hands each test fresh mocks
+        cls._patchers = [patch.object(boto3, "client"), patch.object(boto3, "resource")]
+        cls.client, cls.resource = [patcher.start() for patcher in cls._patchers]
+
+    @classmethod
+    def tearDownClass(cls):
+        for patcher in cls._patchers:
+            patcher.stop()
+
+    def setUp(self):
+        tasks.queues._sqs_client = None
+        tasks.queues._sqs = None
+        self.client.reset_mock(return_value=True, side_effect=True)
+        self.resource.reset_mock(return_value=True, side_effect=True)
+
+    def test_queue(self):
+        r, c = self.resource, self.client
         qh = QueueHandler("test_queue", 60)
         qh.connect()
         self.assertIsInstance(qh.queue, MagicMock)
+        QueueHandler("other_queue", 60).connect()
+        self.assertEqual(r.call_count, 1)
+        self.assertEqual(c.call_count, 1)
+        self.assertEqual(r.call_args[1]["config"].max_pool_connections, 50)
+        self.assertEqual(r.call_args[1]["config"].retries, {"max_attempts": 2})
+
+    def test_create_queue(self):
+        r, c = self.resource, self.client
+        c.return_value.exceptions.QueueDoesNotExist = type("QueueDoesNotExist", (Exception,), {})
+        r.return_value.get_queue_by_name.side_effect = c.return_value.exceptions.QueueDoesNotExist()
+        r.return_value.create_queue.return_value.attributes = {"QueueArn": "arn:test_queue_dlq"}
+        QueueHandler("test_queue", 60).connect()
+        r.return_value.create_queue.assert_called_once_with(
+            QueueName="test_queue",
+            Attributes={"ReceiveMessageWaitTimeSeconds": "20", "VisibilityTimeout": "120"}
+        )
+
+        r.return_value.create_queue.reset_mock()
+        QueueHandler("test_queue", 60, max_receive_count=20).connect()
+        r.return_value.create_queue.assert_any_call(QueueName="test_queue_dlq", Attributes=ANY)
+        attributes = r.return_value.create_queue.call_args[1]["Attributes"]
+        self.assertEqual(
+            json.loads(attributes["RedrivePolicy"]),
+            {"deadLetterTargetArn": "arn:test_queue_dlq", "maxReceiveCount": "20"}
+        )
+
+    def test_existing_queue_redrive_policy(self):
+        r = self.resource
+        queue = Mock(attributes={"QueueArn": "arn:test_queue"})
+        queues = {"test_queue": queue, "test_queue_dlq": Mock(attributes={"QueueArn": "arn:test_queue_dlq"})}
+        r.return_value.get_queue_by_name.side_effect = lambda QueueName: queues[QueueName]
+        QueueHandler("test_queue", 60).connect()
+        queue.set_attributes.assert_not_called()
+
+        qh = QueueHandler("test_queue", 60, max_receive_count=20)
+        qh.connect()
+        attributes = queue.set_attributes.call_args[1]["Attributes"]
+        self.assertEqual(
+            json.loads(attributes["RedrivePolicy"]),
+            {"deadLetterTargetArn": "arn:test_queue_dlq", "maxReceiveCount": "20"}
+        )
+        self.assertEqual(qh.max_receive_count, 20)
+
+        queue.set_attributes.side_effect = ClientError({"Error": {"Code": "AccessDenied"}}, "SetQueueAttributes")
+        qh = QueueHandler("test_queue", 60, max_receive_count=20)
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter("always")
+            qh.connect()
+        self.assertIsNone(qh.max_receive_count)
 
-    @patch.object(boto3, "client")
-    @patch.object(boto3, "resource")
-    def test_send(self, *args):
+        queue.set_attributes.reset_mock()
+        queue.attributes["RedrivePolicy"] = "{}"
+        QueueHandler("test_queue", 60, max_receive_count=20).connect()
+        queue.set_attributes.assert_not_called()
+
+    def test_send(self):
         qh = QueueHandler("test_queue", 60)
         qh.connect()
-        qh.send("test", {1: "one"}, 10, "id")
+        with patch.object(time, "time", return_value=1531225800.5):
+            qh.send("test", {1: "one"}, 10, "id")
         qh.queue.send_message.assert_called_once_with(
             DelaySeconds=10,
             MessageAttributes={
@@ -38,25 +111,74 @@ class QueueHandlerTest(unittest.TestCase):
                 },
                 'when': {
                     'DataType': 'String',
-                    'StringValue': datetime.utcnow().strftime("%d/%m/%y %H:%M:%S")
+                    'StringValue': '10/07/18 12:30:00'
+                },
+                'when_epoch': {
+                    'DataType': 'Number',
+                    'StringValue': '1531225800'
                 },
                 'task_name': {
                     'DataType': 'String',
                     'StringValue': 'test'
-                },
-                'job_id': {'DataType': 'String', 'StringValue': 'unknown'},
-                'job_name': {'DataType': 'String', 'StringValue': 'unknown'}
+                }
             },
             MessageBody='{"1": "one"}'
         )
+        qh.send("test", {1: "one"})
+        exec_id = qh.queue.send_message.call_args[1]["MessageAttributes"]["exec_id"]["StringValue"]
+        self.assertEqual(len(exec_id), 32)
 
-    @patch.object(boto3, "client")
-    @patch.object(boto3, "resource")
-    def test_retrieve(self, *args):
+        qh.send("test", {1: "one"}, job_id="42", job_name="job")
+        attributes = qh.queue.send_message.call_args[1]["MessageAttributes"]
+        self.assertEqual(attributes["job_id"], {'StringValue': '42', 'DataType': 'String'})
+        self.assertEqual(attributes["job_name"], {'StringValue': 'job', 'DataType': 'String'})
+
+        qh.send("test", {1: "one"}, when=datetime(2018, 7, 10, 12, 31))
+        attributes = qh.queue.send_message.call_args[1]["MessageAttributes"]
+        self.assertEqual(attributes["when"]["StringValue"], "10/07/18 12:31:00")
+        self.assertEqual(attributes["when_epoch"]["StringValue"], "1531225860")
+
+    def test_queue_len(self):
+        c = self.client
         qh = QueueHandler("test_queue", 60)
         qh.connect()
-        with warnings.catch_warnings(record=True):
-            qh.retrieve(50)
+        c.return_value.get_queue_attributes.return_value = {"Attributes": {"ApproximateNumberOfMessages": "7"}}
+        self.assertEqual(qh.queue_len(), 7)
+        c.return_value.get_queue_attributes.assert_called_once_with(
+            QueueUrl=qh.queue.url, AttributeNames=["ApproximateNumberOfMessages"]
+        )
+        qh.queue.load.assert_not_called()
+
+    def test_send_many(self):
+        qh = QueueHandler("test_queue", 60)
+        qh.connect()
+        qh.queue.send_messages.return_value = {"Failed": [{"Id": "1"}]}
+        tasks_sent = [("test", {"n": n}, 0, str(n)) for n in range(12)]
+        self.assertEqual(qh.send_many(tasks_sent, job_id="42"), [tasks_sent[1], tasks_sent[11]])
+        self.assertEqual(qh.queue.send_messages.call_count, 2)
+        entries = qh.queue.send_messages.call_args_list[0][1]["Entries"]
+        self.assertEqual(len(entries), 10)
+        self.assertEqual(entries[3]["Id"], "3")
+        self.assertEqual(entries[3]["MessageAttributes"]["exec_id"]["StringValue"], "3")
+        self.assertEqual(entries[3]["MessageAttributes"]["job_id"]["StringValue"], "42")
+        self.assertEqual(json.loads(entries[3]["MessageBody"]), {"n": 3})
+
+        # Batches also stay within the SQS payload limit
+        qh.queue.send_messages.reset_mock()
+        qh.queue.send_messages.return_value = {}
+        big = "x" * 100000
+        self.assertEqual(qh.send_many([("test", {"big": big}) for _ in range(5)]), [])
+        self.assertEqual([len(c[1]["Entries"]) for c in qh.queue.send_messages.call_args_list], [2, 2, 1])
+        self.assertEqual(qh.queue.send_messages.call_args_list[1][1]["Entries"][1]["Id"], "1")
+
+        qh.queue.send_messages.side_effect = Exception()
+        self.assertEqual(qh.send_many([("test", {})]), [("test", {})])
+
+    def test_retrieve(self):
+        qh = QueueHandler("test_queue", 60)
+        qh.connect()
+        qh.queue.receive_messages.return_value = []
+        self.assertEqual(qh.retrieve(50), [])
         qh.queue.receive_messages.assert_called_once_with(
             AttributeNames=[
                 'ApproximateReceiveCount',
@@ -65,20 +187,104 @@ class QueueHandlerTest(unittest.TestCase):
             MessageAttributeNames=['All'],
             MaxNumberOfMessages=10,
             VisibilityTimeout=60,
-            WaitTimeSeconds=1,
+            WaitTimeSeconds=20,
         )
 
-    def test_done(self, *args):
-        m = MagicMock()
+        qh.queue.receive_messages.reset_mock()
+        qh.queue.receive_messages.side_effect = [["m"] * 10, ["m"] * 3]
+        self.assertEqual(len(qh.retrieve(15)), 13)
+        self.assertEqual(qh.queue.receive_messages.call_count, 2)
+        self.assertEqual(qh.queue.receive_messages.call_args[1]["MaxNumberOfMessages"], 5)
+
+    def test_done(self):
+        m = Mock()
         QueueHandler.done(m)
-        m.delete.assert_called_once()
+        m.delete.assert_called_once_with()
+
+    def test_done_later(self):
+        qh = QueueHandler("test_queue", 60)
+        qh.connect()
+        m = Mock(receipt_handle="handle")
+        qh.done_later(m)
+        qh.queue.delete_messages.assert_not_called()
+        qh.flush_deletes()
+        qh.queue.delete_messages.assert_called_once_with(Entries=[{"Id": "0", "ReceiptHandle": "handle"}])
+
+        qh.queue.delete_messages.reset_mock()
+        for _ in range(12):
+            qh.done_later(m)
+        self.assertEqual(len(qh._deletes_in_flight), 1)
+        self.assertEqual(len(qh._pending_deletes), 2)
+        qh.flush_deletes()
+        self.assertEqual(qh.queue.delete_messages.call_count, 2)
+        self.assertEqual(qh._deletes_in_flight, [])
+        qh.flush_deletes()
+        self.assertEqual(qh.queue.delete_messages.call_count, 2)
+
+        # Batches are sent concurrently and a failing one does not stop the others
+        qh.queue.delete_messages.reset_mock()
+        qh.queue.delete_messages.side_effect = [Exception(), {"Failed": []}, {"Failed": []}]
+        qh._pending_deletes = [m] * 25
+        with patch.object(tasks.queues, "_logger") as l:
+            qh.flush_deletes()
+            self.assertEqual(l.exception.call_count, 1)
+        self.assertEqual(qh.queue.delete_messages.call_count, 3)
+
+    def test_done_many_later(self):
+        qh = QueueHandler("test_queue", 60)
+        qh.connect()
+        m = Mock(receipt_handle="handle")
+        qh.done_many_later([m] * 25)
+        self.assertEqual(len(qh._deletes_in_flight), 2)
+        self.assertEqual(len(qh._pending_deletes), 5)
+        qh.flush_deletes()
+        self.assertEqual(qh.queue.delete_messages.call_count, 3)
+
+    def test_postpone_later(self):
+        qh = QueueHandler("test_queue", 60)
+        qh.connect()
+        m = Mock(receipt_handle="handle")
+        qh.postpone_later(m, 30.5)
+        qh.queue.change_message_visibility_batch.assert_not_called()
+        qh.flush_postpones()
+        qh.queue.change_message_visibility_batch.assert_called_once_with(
+            Entries=[{"Id": "0", "ReceiptHandle": "handle", "VisibilityTimeout": 30}]
+        )
+
+        qh.queue.change_message_visibility_batch.reset_mock()
+        for _ in range(12):
+            qh.postpone_later(m, 10)
+        qh.flush_postpones()
+        self.assertEqual(qh.queue.change_message_visibility_batch.call_count, 2)
+        qh.flush_postpones()
+        self.assertEqual(qh.queue.change_message_visibility_batch.call_count, 2)
 
-    @patch.object(boto3, "client")
-    @patch.object(boto3, "resource")
-    def test_postpone(self, *args):
+    def test_postpone_batch(self):
+        qh = QueueHandler("test_queue", 60)
+        qh.connect()
+        m = Mock(receipt_handle="handle")
+        qh.queue.change_message_visibility_batch.return_value = {"Failed": [{"Id": "1"}]}
+        self.assertEqual(qh.postpone_batch([(m, 30), (m, 60)]), {1})
+        qh.queue.change_message_visibility_batch.assert_called_once_with(Entries=[
+            {"Id": "0", "ReceiptHandle": "handle", "VisibilityTimeout": 30},
+            {"Id": "1", "ReceiptHandle": "handle", "VisibilityTimeout": 60}
+        ])
+        qh.queue.change_message_visibility_batch.side_effect = Exception()
+        self.assertEqual(qh.postpone_batch([(m, 30), (m, 60)]), {0, 1})
+
+    def test_postpone(self):
         m = MagicMock()
         self.assertTrue(QueueHandler.postpone(m, 60))
-        m.change_visibility.called_once_with(VisibilityTimeout=60)
+        m.change_visibility.assert_called_once_with(VisibilityTimeout=60)
+
+        m.change_visibility.side_effect = ClientError(
+            {"Error": {"Code": "ReceiptHandleIsInvalid"}}, "ChangeMessageVisibility"
+        )
+        self.assertFalse(QueueHandler.postpone(m, 60))
+
+        m.change_visibility.side_effect = EndpointConnectionError(endpoint_url="https://sqs")
+        self.assertFalse(QueueHandler.postpone(m, 60))
 
-        m.change_visibility.side_effect = Exception()
-        self.assertFalse(QueueHandler.postpone(m, 60))
\ No newline at end of file
+        m.change_visibility.side_effect = ValueError()
+        with self.assertRaises(ValueError):
+            QueueHandler.postpone(m, 60)
\ No newline at end of file
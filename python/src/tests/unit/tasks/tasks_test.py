@@ -7,56 +7,74 @@ created_at: 11-JUN-2018
 updated_at: 11-JUL-2018
 """
 from samba_chassis import tasks
-from samba_chassis.tasks import *
-from mock import MagicMock, patch, ANY
+from samba_chassis.tasks import Task
+from mock import Mock, patch
 import unittest
-import boto3
-from datetime import datetime, timedelta
-import warnings
 
 
 class TaskTest(unittest.TestCase):
 
     def test_send(self, *args):
-        qh = MagicMock()
+        qh = Mock()
         Task.send("Test", {}, qh, 0, "id")
         qh.send.assert_called_once_with("Test", {}, 0, "id", None)
 
     @patch.object(tasks, "_logger")
     def test_invalid_progression(self, *args):
-        qh = MagicMock()
+        qh = Mock()
         with self.assertRaises(ValueError):
             Task("Test", lambda: True, qh, 10, "fail", 10, "WRONG")
             tasks._logger.error.assert_called_with("INVALID_PROGRESSION")
 
     def test_get_delay(self, *args):
-        qh = MagicMock()
-        t = Task("Test", lambda: True, qh, 10, "fail", 10, "NONE")
+        qh = Mock()
+        for progression, delay in (("NONE", 10), ("ARITHMETIC", 30), ("GEOMETRIC", 90)):
+            with self.subTest(progression=progression):
+                t = Task("Test", lambda: True, qh, 10, "fail", 10, progression)
+                self.assertEqual(t.get_delay(0), 0)
+                self.assertEqual(t.get_delay(3), delay)
+
+        t = Task("Test", lambda: True, qh, 10, "fail", 10, "RANDOM")
         self.assertEqual(t.get_delay(0), 0)
-        self.assertEqual(t.get_delay(3), 10)
+        self.assertLessEqual(t.get_delay(3), 20)
+        self.assertGreaterEqual(t.get_delay(3), 5)
 
-        t = Task("Test", lambda: True, qh, 10, "fail", 10, "ARITHMETIC")
+        t = Task("Test", lambda: True, qh, 10, "fail", 10, "GEOMETRIC_JITTER")
         self.assertEqual(t.get_delay(0), 0)
-        self.assertEqual(t.get_delay(3), 30)
+        self.assertLessEqual(t.get_delay(3), 90)
+        self.assertGreaterEqual(t.get_delay(3), 0)
 
-        t = Task("Test", lambda: True, qh, 10, "fail", 10, "GEOMETRIC")
+        t = Task("Test", lambda: True, qh, 10, "fail", 10, "ARITHMETIC_JITTER")
         self.assertEqual(t.get_delay(0), 0)
-        self.assertEqual(t.get_delay(3), 90)
+        self.assertLessEqual(t.get_delay(3), 30)
+        self.assertGreaterEqual(t.get_delay(3), 0)
 
-        t = Task("Test", lambda: True, qh, 10, "fail", 10, "RANDOM")
+        t = Task("Test", lambda: True, qh, 10, "fail", 10, "EXPONENTIAL")
         self.assertEqual(t.get_delay(0), 0)
-        self.assertLessEqual(t.get_delay(3), 20)
-        self.assertGreaterEqual(t.get_delay(3), 5)
+        self.assertEqual(t.get_delay(1), 10)
+        self.assertEqual(t.get_delay(4), 80)
+        # Past the precomputed retries and capped at SQS's maximum visibility timeout
+        self.assertEqual(t.get_delay(30), 43200)
+
+        t = Task("Test", lambda: True, qh, 10, "fail", 10, "EXPONENTIAL_JITTER")
+        self.assertEqual(t.get_delay(0), 0)
+        self.assertLessEqual(t.get_delay(4), 80)
+        self.assertGreaterEqual(t.get_delay(4), 0)
+        self.assertLessEqual(t.get_delay(30), 43200)
+
+    def test_slots(self, *args):
+        t = Task("Test", lambda: True, Mock(), 10, "fail", 10, "NONE")
+        self.assertFalse(hasattr(t, "__dict__"))
 
     def test_issue(self, *args):
-        qh = MagicMock()
+        qh = Mock()
         t = Task("Test", lambda: True, qh, 10, "fail", 10, "NONE")
         t.issue({1: "one"}, 10, "id")
         qh.send.assert_called_once_with("Test", {1: "one"}, 10, "id", None)
 
     def test_issue_fail(self, *args):
-        qh1 = MagicMock()
-        qh2 = MagicMock()
+        qh1 = Mock()
+        qh2 = Mock()
         t = Task("Test", lambda: True, qh1, 10, "fail", 10, "NONE")
         t.issue_fail({1: "one"})
         qh1.send.assert_called_with("fail", {1: "one"}, 0, None, None)
@@ -66,7 +84,7 @@ class TaskTest(unittest.TestCase):
         qh2.send.assert_called_with("fail", {1: "one"}, 0, None, None)
 
     def test_run(self, *args):
-        qh = MagicMock()
+        qh = Mock()
 
         t = Task("Test", lambda attr: True, qh, 10, "fail", 10, "NONE")
         self.assertTrue(t.run({1: "one"}, 0))
@@ -75,4 +93,20 @@ class TaskTest(unittest.TestCase):
         self.assertFalse(t.run({1: "one"}, 0))
 
         t = Task("Test", lambda: True, qh, 10, "fail", 10, "NONE")
-        self.assertFalse(t.run({1: "one"}, 0))
\ No newline at end of file
+        self.assertFalse(t.run({1: "one"}, 0))
+
+        executor = Mock()
+        executor.submit.return_value.result.return_value = False
+        t = Task("Test", lambda attr: True, qh, 10, "fail", 10, "NONE")
+        self.assertFalse(t.run({1: "one"}, 0, executor=executor))
+        executor.submit.assert_called_once_with(t.func, {1: "one"})
+
+        # Out of retries: issue the on_fail task, if any, and report success so the message is dropped
+        t = Task("Test", lambda attr: False, qh, 3, "fail", 10, "NONE")
+        self.assertTrue(t.run({1: "one"}, 3))
+        qh.send.assert_called_once_with("fail", {1: "one"}, 0, None, None)
+        qh.send.side_effect = Exception()
+        self.assertTrue(t.run({1: "one"}, 3))
+        t = Task("Test", lambda attr: False, qh, 3, None, 10, "NONE")
+        self.assertTrue(t.run({1: "one"}, 3))
+        self.assertEqual(qh.send.call_count, 2)